@@ -1,7 +1,27 @@
+import time
+_RUN_STARTED = time.perf_counter()
+
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import date, datetime
-import time
+import importlib.util
+import io
+import tempfile
+from contextlib import ExitStack
+
+import kpi_core
+from kpi_core import (
+    DAY_FIRST_ROW, DAY_LAST_ROW, KPI_FIRST_COL, NUMERIC_JUNK_PATTERN, STORE_NAMES, KpiHistory, RosterWarmer,
+    a1_range, check_connection_status, coalesce_submissions,
+    export_month_csv, export_month_xlsx, fetch_roster, iter_cached_month_rows,
+    get_api_guard, get_api_tracer, get_config_cache, get_drive_index, get_gspread_client, get_roster_cache,
+    get_row_locks, get_sheet_file_info, get_snapshot_cache, get_working_folder_id, get_write_queue, ingest_month,
+    kpi_config_key, kpi_layout, latest_snapshot_info, list_month_store_files, load_latest_snapshot,
+    load_system_config, merged_row_values, parse_numeric_block, quote_sheet_title, read_sheet_robust_v13,
+    scan_month_staff, scan_month_stores, store_name_from_file,
+    summarize_trace, trace_action, update_google_sheet_robust,
+)
 
 # --- 1. 系統初始化 ---
 st.set_page_config(page_title="全店業績戰情室", layout="wide", page_icon="📈")
@@ -11,160 +31,53 @@ if 'preview_data' not in st.session_state: st.session_state.preview_data = None
 if 'authenticated_store' not in st.session_state: st.session_state.authenticated_store = None
 if 'admin_logged_in' not in st.session_state: st.session_state.admin_logged_in = False
 if 'current_excel_file' not in st.session_state: st.session_state.current_excel_file = None
-if 'kpi_config' not in st.session_state: st.session_state.kpi_config = None # 緩存設定
 
-# 檢查 Secrets
-if "gcp_service_account" not in st.secrets:
+# 檢查 Secrets (KPI_BACKEND = "fake" 時使用 fake_backend 的離線假資料，不需要服務帳號)
+if "gcp_service_account" not in st.secrets and st.secrets.get("KPI_BACKEND", "google") != "fake":
     st.error("❌ 嚴重錯誤：Secrets 中找不到 [gcp_service_account]。")
     st.stop()
 if "TARGET_FOLDER_ID" not in st.secrets:
     st.warning("⚠️ 警告：Secrets 中找不到 TARGET_FOLDER_ID。")
 
-# 匯入 Google 套件
-try:
-    import gspread
-    from google.oauth2.service_account import Credentials
-    from googleapiclient.discovery import build 
-except ImportError:
+# 檢查 Google 套件是否已安裝，缺少時顯示提示 (實際匯入在 get_gspread_client 建立連線時)
+if any(importlib.util.find_spec(pkg) is None for pkg in ("gspread", "google.oauth2", "googleapiclient")):
     st.error("❌ 缺少套件，請在 requirements.txt 加入 `gspread`, `google-auth`, `google-api-python-client`")
     st.stop()
 
-# ==============================================================================
-# ⚙️ 預設設定 (Fallback) - 當雲端設定檔讀取失敗時使用
-# ==============================================================================
-DEFAULT_KPI_CONFIG = {
-    "毛利":       {"col": 0,  "type": "money",  "cat": "finance", "label": "毛利 ($)"},
-    "門號":       {"col": 1,  "type": "int",    "cat": "finance", "label": "門號 (件)"},
-    "保險營收":   {"col": 2,  "type": "money",  "cat": "finance", "label": "保險營收 ($)"},
-    "配件營收":   {"col": 3,  "type": "money",  "cat": "finance", "label": "配件營收 ($)"},
-    "庫存手機":   {"col": 4,  "type": "int",    "cat": "hardware", "label": "庫存手機 (台)"},
-    "蘋果手機":   {"col": 5,  "type": "int",    "cat": "hardware", "label": "蘋果手機 (台)"},
-    "蘋果平板+手錶": {"col": 6, "type": "int",  "cat": "hardware", "label": "蘋果平板/手錶 (台)"},
-    "華為穿戴":     {"col": 7,  "type": "int",    "cat": "target",   "label": "華為穿戴 (台)"},
-    "橙艾玻璃貼":   {"col": 8,  "type": "int",    "cat": "target",   "label": "橙艾玻璃貼 (張)"},
-    "VIVO銷售目標": {"col": 9,  "type": "int",    "cat": "target",   "label": "VIVO銷售目標 (台)"},
-    "GPLUS吸塵器":  {"col": 10, "type": "int",    "cat": "target",   "label": "GPLUS吸塵器 (台)"},
-    "生活圈":       {"col": 11, "type": "int",    "cat": "service",  "label": "生活圈 (人)"},
-    "GOOGLE 評論":  {"col": 12, "type": "int",    "cat": "service",  "label": "Google 評論 (則)"},
-    "來客數":       {"col": 13, "type": "int",    "cat": "service",  "label": "來客數 (人)"},
-    "遠傳續約":        {"col": 14, "type": "int",    "cat": "project",  "label": "遠傳續約 (件)"},
-    "遠傳續約累積GAP": {"col": 15, "type": "int",    "cat": "project",  "label": "續約累積 GAP"},
-    "遠傳升續率":      {"col": 16, "type": "percent","cat": "project",  "label": "升續率 (%)", "mode": "overwrite"},
-    "遠傳平續率":      {"col": 17, "type": "percent","cat": "project",  "label": "平續率 (%)", "mode": "overwrite"},
-    "綜合指標":        {"col": 18, "type": "float",  "cat": "score",    "label": "綜合指標分數", "mode": "overwrite"}
-}
-
-# --- 2. Google Sheets 連線與工具 ---
-
-@st.cache_resource
-def get_gspread_client():
-    scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
-    creds_dict = dict(st.secrets["gcp_service_account"])
-    creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
-    client = gspread.authorize(creds)
-    drive_service = build('drive', 'v3', credentials=creds)
-    return client, drive_service, creds.service_account_email
-
-def check_connection_status():
-    try:
-        _, _, email = get_gspread_client()
-        return True, email
-    except: return False, None
-
-# --- 核心：動態載入設定檔 (v17.0 Feature) ---
-def load_system_config():
-    """
-    嘗試從 Google Drive 讀取 'system_kpi_config' 試算表。
-    若失敗則回傳預設設定。
-    """
-    if st.session_state.kpi_config:
-        return st.session_state.kpi_config
-
-    folder_id = st.secrets.get("TARGET_FOLDER_ID")
-    client, drive_service, _ = get_gspread_client()
-    
-    # 搜尋設定檔
-    query = f"name = 'system_kpi_config' and trashed = false and '{folder_id}' in parents"
-    try:
-        results = drive_service.files().list(q=query, fields="files(id)").execute()
-        files = results.get('files', [])
-        
-        if files:
-            sh = client.open_by_key(files[0]['id'])
-            ws = sh.worksheet("Config")
-            data = ws.get_all_records() # 預設第一列為標題
-            
-            new_config = {}
-            for row in data:
-                # 簡單的資料驗證
-                key = str(row.get('名稱', '')).strip()
-                if not key: continue
-                
-                new_config[key] = {
-                    "col": int(row.get('Excel欄位(0起始)', 0)),
-                    "type": str(row.get('類型', 'int')),
-                    "cat": str(row.get('分類', 'finance')),
-                    "label": str(row.get('顯示標籤', key)),
-                    "mode": str(row.get('模式', ''))
-                }
-            
-            st.session_state.kpi_config = new_config
-            # print("✅ 成功載入雲端設定檔")
-            return new_config
-            
-    except Exception as e:
-        print(f"⚠️ 讀取設定檔失敗 ({e})，使用預設設定。")
-    
-    st.session_state.kpi_config = DEFAULT_KPI_CONFIG
-    return DEFAULT_KPI_CONFIG
+# 讀取與彙整核心 (kpi_core) 與排程 CLI 共用，設定值由 Secrets 傳入
+kpi_core.configure(st.secrets.to_dict())
+
+# 全店掃描的並行讀取數 (可於 Secrets 設定 SCAN_MAX_WORKERS)
+SCAN_MAX_WORKERS = int(st.secrets.get("SCAN_MAX_WORKERS", 8))
+# 全店掃描只讀取 KPI_CONFIG 用到的欄位 (合併成連續區段後一次 batch_get)
+SCAN_COLUMN_PROJECTION = bool(st.secrets.get("SCAN_COLUMN_PROJECTION", True))
+# 背景預載人員名單的週期 (秒)；名單超過兩個週期未更新就改回同步讀取
+ROSTER_REFRESH_SECONDS = int(st.secrets.get("ROSTER_REFRESH_SECONDS", 300))
+# 批次補登：每次 values.batchUpdate 最多帶幾個儲存格區段
+BACKFILL_CHUNK_RANGES = int(st.secrets.get("BACKFILL_CHUNK_RANGES", 500))
+# 排程 (build_snapshot.py) 寫入的全店快照目錄
+SNAPSHOT_DIR = st.secrets.get("SNAPSHOT_DIR", "snapshots")
+# 本機歷史 KPI 資料庫 (多月趨勢) 路徑；月份結束後幾天內仍視為進行中 (保留月初補登)
+HISTORY_PATH = st.secrets.get("HISTORY_PATH", "kpi_history.sqlite3")
+HISTORY_GRACE_DAYS = int(st.secrets.get("HISTORY_GRACE_DAYS", 5))
+# Drive 索引 TTL、API 配額 (SHEETS_/DRIVE_QUOTA_PER_MINUTE)、API 追蹤保留筆數 (API_TRACE_MAX_EVENTS)、設定檔重新檢查秒數、
+# 上傳佇列路徑 (WRITE_QUEUE_PATH)、快照快取容量 (SNAPSHOT_CACHE_MB)、名單預載並行數 (ROSTER_MAX_WORKERS) 等由 kpi_core 讀取
 
 # 載入設定 (全域變數)
-KPI_CONFIG = load_system_config()
-
-# --- 一般工具函式 ---
-
-def get_working_folder_id(drive_service, root_folder_id, date_obj):
-    folder_name = date_obj.strftime("%Y%m")
-    query = f"name = '{folder_name}' and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
-    try:
-        results = drive_service.files().list(q=query, fields="files(id, name)").execute()
-        files = results.get('files', [])
-        if files: return files[0]['id']
-        else: return root_folder_id 
-    except: return root_folder_id
-
-def get_sheet_file_info(drive_service, filename, folder_id):
-    query = f"name = '{filename}' and trashed = false"
-    if folder_id: query += f" and '{folder_id}' in parents"
-    try:
-        results = drive_service.files().list(q=query, fields="files(id, name, webViewLink, mimeType)").execute()
-        return results.get('files', [])
-    except: return []
-
-def safe_float(value):
-    try:
-        if value in [None, "", " ", "-"]: return 0.0
-        clean_val = str(value).replace(",", "").replace("$", "").replace("%", "").replace(" ", "").strip()
-        if not clean_val: return 0.0
-        return float(clean_val)
-    except ValueError: return 0.0
-
-def make_columns_unique(columns):
-    seen = {}
-    new_columns = []
-    for i, col in enumerate(columns):
-        col_name = str(col).strip() if str(col).strip() else f"Column_{i}"
-        if col_name in seen:
-            seen[col_name] += 1
-            new_columns.append(f"{col_name}_{seen[col_name]}")
-        else:
-            seen[col_name] = 0
-            new_columns.append(col_name)
-    return new_columns
+with trace_action("載入 KPI 設定"):
+    KPI_CONFIG = load_system_config()
+KPI_LAYOUT = kpi_layout(KPI_CONFIG)
+
+# --- 人員名單 (背景預載) ---
 
-@st.cache_data(ttl=60)
 def fetch_dynamic_staff_list(store_name, date_obj):
+    """優先使用背景預載的名單；沒有或已過期時同步讀取並寫回共用快取。API 錯誤直接拋出。"""
     if store_name == "(ALL) 全店總表": return []
+    cache = get_roster_cache()
+    month_key = date_obj.strftime('%Y_%m')
+    roster = cache.get(store_name, month_key)
+    if roster is not None: return roster
+
     root_id = st.secrets.get("TARGET_FOLDER_ID")
     client, drive_service, _ = get_gspread_client()
     folder_id = get_working_folder_id(drive_service, root_id, date_obj)
@@ -172,139 +85,191 @@ def fetch_dynamic_staff_list(store_name, date_obj):
     files = get_sheet_file_info(drive_service, filename, folder_id)
     target_file = next((f for f in files if "google-apps.spreadsheet" in f['mimeType']), None)
     if not target_file: return []
-    try:
-        sh = client.open_by_key(target_file['id'])
-        all_sheets = [ws.title for ws in sh.worksheets()]
-        exclude_list = ["總表", "總計", "Total", "TOTAL", "Log", "設定", "Config", store_name]
-        return [s for s in all_sheets if s not in exclude_list]
-    except: return []
+    roster = fetch_roster(client, target_file['id'], store_name)
+    cache.put(store_name, month_key, roster, target_file.get('modifiedTime'))
+    return roster
 
 # --- 讀取與彙整功能 (使用動態 CONFIG) ---
 
-def scan_and_aggregate_stores(date_obj):
-    root_id = st.secrets.get("TARGET_FOLDER_ID")
-    client, drive_service, _ = get_gspread_client()
-    folder_id = get_working_folder_id(drive_service, root_id, date_obj)
-    
-    try:
-        query = f"'{folder_id}' in parents and mimeType = 'application/vnd.google-apps.spreadsheet' and trashed = false"
-        results = drive_service.files().list(q=query, fields="files(id, name, webViewLink)").execute()
-        all_files = results.get('files', [])
-    except Exception as e: return None, f"無法讀取資料夾: {e}"
-
-    target_pattern = f"{date_obj.strftime('%Y_%m')}_.+店業績日報表"
-    valid_files = [f for f in all_files if "店業績日報表" in f['name'] and "(ALL)" not in f['name'] and f['name'].startswith(date_obj.strftime('%Y_%m'))]
-
-    if not valid_files: return None, f"找不到符合 {target_pattern} 的檔案"
+@st.cache_resource
+def get_cube_cache():
+    """月份 (YYYYMM) → 最近一次全店掃描結果 {'cube', 'df', 'msg', 'scanned_at'}，全程序共用。"""
+    return {}
 
-    aggregated_data = []
+def scan_and_aggregate_stores(date_obj, max_workers=SCAN_MAX_WORKERS, use_cache=True):
+    """介面用的全店掃描：顯示進度條，結果放入共用的 cube 快取。"""
     prog_bar = st.progress(0, text="掃描中...")
-    
-    # 動態計算需要讀取的最大欄位數 (避免讀太少)
-    max_col_index = max([v['col'] for v in KPI_CONFIG.values()]) + 2 # +2 offset just in case
-    # 轉換成 Excel 欄位字母 (簡易版，支援到 Z)
-    end_char = chr(65 + max_col_index + 1) # B is index 1, so offset
-    if max_col_index > 24: end_char = "Z" # Fallback simplicity
-    
-    range_str = f"B15:{end_char}45"
+    def show_progress(done, total, store_name):
+        prog_bar.progress(int(done / total * 100), text=f"讀取：{store_name} ({done}/{total})")
+    df, msg, cube = scan_month_stores(date_obj, max_workers, use_cache, SCAN_COLUMN_PROJECTION, progress=show_progress)
+    prog_bar.empty()
+    if cube is not None:
+        get_cube_cache()[cube.month] = {"cube": cube, "df": df, "msg": msg, "scanned_at": time.time(), "source": "live"}
+    return df, msg
 
-    for idx, f in enumerate(valid_files):
-        store_name = f['name'].split('_')[-1].replace('業績日報表', '')
-        prog_bar.progress(int((idx+1)/len(valid_files)*100), text=f"讀取：{store_name}")
-        
-        stat = {"門市": store_name, "連結": f['webViewLink']}
-        for key in KPI_CONFIG: stat[key] = 0
-        
-        try:
-            sh = client.open_by_key(f['id'])
-            ws = None
-            try: ws = sh.worksheet(store_name)
-            except: 
-                try: ws = sh.worksheet("總表")
-                except: pass
-            
-            if ws:
-                data = ws.get(range_str)
-                for row in data:
-                    if len(row) > 0:
-                        for key, cfg in KPI_CONFIG.items():
-                            col_idx = cfg['col']
-                            val = safe_float(row[col_idx]) if len(row) > col_idx else 0
-                            if cfg.get('mode') == 'overwrite':
-                                if val != 0: stat[key] = val
-                            else:
-                                stat[key] += val
-
-        except Exception as e: print(e)
-        aggregated_data.append(stat)
-    
+@st.cache_resource
+def get_kpi_history():
+    return KpiHistory(HISTORY_PATH)
+
+@st.cache_resource
+def get_staff_cache():
+    """月份 (YYYYMM) → 最近一次人員層級掃描結果 {'df', 'daily', 'msg', 'scanned_at'}，全程序共用。"""
+    return {}
+
+def scan_staff_leaderboard(date_obj, max_workers=SCAN_MAX_WORKERS, use_cache=True):
+    """介面用的人員層級掃描：顯示進度條，結果放入共用的人員快取。"""
+    prog_bar = st.progress(0, text="讀取人員分頁...")
+    def show_progress(done, total, store_name):
+        prog_bar.progress(int(done / total * 100), text=f"讀取人員分頁：{store_name} ({done}/{total})")
+    df, msg, daily = scan_month_staff(date_obj, max_workers, use_cache, SCAN_COLUMN_PROJECTION, progress=show_progress)
     prog_bar.empty()
-    return pd.DataFrame(aggregated_data), f"✅ 掃描完成：{len(valid_files)} 間門市"
+    if df is not None:
+        get_staff_cache()[date_obj.strftime('%Y%m')] = {"df": df, "daily": daily, "msg": msg, "scanned_at": time.time()}
+    return df, msg
 
-def update_google_sheet_robust(store, staff, date_obj, data_dict):
-    root_id = st.secrets.get("TARGET_FOLDER_ID")
-    client, drive_service, _ = get_gspread_client()
-    folder_id = get_working_folder_id(drive_service, root_id, date_obj)
-    
-    filename = f"{date_obj.year}_{date_obj.month:02d}_{store}業績日報表"
-    files = get_sheet_file_info(drive_service, filename, folder_id)
-    target_file = next((f for f in files if "google-apps.spreadsheet" in f['mimeType']), None)
-    
-    if not target_file: return f"❌ 找不到檔案：{filename}"
-    
-    try:
-        sh = client.open_by_key(target_file['id'])
-        ws = sh.worksheet(staff)
-        target_row = 15 + (date_obj.day - 1)
-        
-        updates = []
-        for field, new_val in data_dict.items():
-            if field in KPI_CONFIG and new_val is not None:
-                cfg = KPI_CONFIG[field]
-                col_idx = cfg['col'] + 2 # B=2
-                
-                if cfg.get('mode') == 'overwrite':
-                    updates.append({'range': gspread.utils.rowcol_to_a1(target_row, col_idx), 'values': [[new_val]]})
-                else:
-                    old_val = ws.cell(target_row, col_idx).value
-                    final_val = safe_float(old_val) + new_val
-                    updates.append({'range': gspread.utils.rowcol_to_a1(target_row, col_idx), 'values': [[final_val]]})
-        
-        if updates: ws.batch_update(updates)
-        return f"✅ 寫入成功：{filename}"
-    except Exception as e: return f"❌ 寫入錯誤：{e}"
+# --- 批次補登匯入 (Excel / CSV) ---
 
-def read_sheet_robust_v13(store, date_obj):
-    root_id = st.secrets.get("TARGET_FOLDER_ID")
+BACKFILL_KEY_COLUMNS = ["門市", "人員", "日期"]
+
+def load_backfill_file(uploaded):
+    """讀取補登檔 (Excel 用 openpyxl，或 CSV)，所有欄位先以字串讀入，之後再驗證。"""
+    if uploaded.name.lower().endswith(".csv"):
+        return pd.read_csv(uploaded, dtype=str, keep_default_na=False)
+    return pd.read_excel(uploaded, dtype=str, engine="openpyxl", keep_default_na=False)
+
+def validate_backfill_rows(df, store_names, config=None):
+    """
+    依 KPI_CONFIG 驗證補登資料：KPI 欄名可用代號或顯示名稱，空白儲存格略過，其餘需可轉成數字。
+    percent 欄位寫成「85%」時換算為 0.85 (與表單輸入相同)，未帶 % 的值視為已是小數。
+    同一 (門市, 人員, 日期) 的多列依 coalesce_submissions 規則合併。
+    回傳 ([(門市, 人員, 日期, {KPI: 值})], 錯誤訊息清單)。
+    """
+    config = config or KPI_CONFIG
+    missing = [c for c in BACKFILL_KEY_COLUMNS if c not in df.columns]
+    if missing: return [], [f"缺少必要欄位：{', '.join(missing)}"]
+
+    by_name = {k: k for k in config} | {cfg['label']: k for k, cfg in config.items()}
+    kpi_cols = {c: by_name[c] for c in df.columns if c in by_name}
+    errors = [f"未知欄位已略過：{c}" for c in df.columns if c not in kpi_cols and c not in BACKFILL_KEY_COLUMNS]
+    if not kpi_cols: return [], errors + ["沒有任何可匯入的 KPI 欄位"]
+
+    # 各列日期分別判斷格式，同一檔混用 2025-09-01 / 2025/09/02 也能解析
+    dates = pd.to_datetime(df["日期"].str.strip(), format="mixed", errors="coerce")
+    values = df[list(kpi_cols)].apply(lambda s: s.str.replace(NUMERIC_JUNK_PATTERN, "", regex=True).str.strip())
+    numbers = values.apply(pd.to_numeric, errors="coerce")
+    for c, key in kpi_cols.items():
+        if config[key]['type'] == 'percent':
+            numbers[c] = numbers[c].where(~df[c].str.contains("%", regex=False), numbers[c] / 100.0)
+
+    grouped = {}
+    for i, (store, staff) in enumerate(zip(df["門市"].str.strip(), df["人員"].str.strip())):
+        line = i + 2  # 第 1 列為標題
+        if store not in store_names: errors.append(f"第 {line} 列：未知門市「{store}」"); continue
+        if not staff: errors.append(f"第 {line} 列：缺少人員"); continue
+        if pd.isna(dates.iloc[i]): errors.append(f"第 {line} 列：日期無法解析「{df['日期'].iloc[i]}」"); continue
+        bad = [c for c in kpi_cols if values[c].iloc[i] != "" and pd.isna(numbers[c].iloc[i])]
+        if bad: errors.append(f"第 {line} 列：非數字欄位 {', '.join(bad)}"); continue
+        data = {kpi_cols[c]: float(numbers[c].iloc[i]) for c in kpi_cols if values[c].iloc[i] != ""}
+        if data: grouped.setdefault((store, staff, dates.iloc[i].date()), []).append(data)
+
+    rows = [(store, staff, day, coalesce_submissions(payloads)) for (store, staff, day), payloads in grouped.items()]
+    return rows, errors
+
+def _row_span_updates(sheet_title, row, cells):
+    """將同一列的 {欄位索引: 值} 依連續欄位合併成最少的 A1 區段。"""
+    updates, run = [], []
+    for col in sorted(cells):
+        if run and col != run[-1] + 1:
+            updates.append(run); run = []
+        run.append(col)
+    if run: updates.append(run)
+    return [
+        {'range': f"{quote_sheet_title(sheet_title)}!{a1_range(KPI_FIRST_COL + r[0], row, KPI_FIRST_COL + r[-1], row)}",
+         'values': [[cells[c] for c in r]]}
+        for r in updates
+    ]
+
+def write_backfill_file(client, file_id, items, chunk_ranges=BACKFILL_CHUNK_RANGES):
+    """
+    將同一檔案的補登列寫入各人員分頁，API 呼叫次數固定：
+    1 次 metadata + 1 次 batchGet 讀取目前值 + ceil(區段數 / chunk_ranges) 次 values.batchUpdate。
+    讀取到寫入完成之間持有所有相關列的 RowLocks，只防得住本程序內的上傳佇列同時改同一列；
+    其他程序或有人直接編輯試算表時，這段期間寫入的數值會被覆蓋。
+    回傳 (寫入列數, 錯誤訊息清單)。
+    """
+    metadata = client.http_client.fetch_sheet_metadata(file_id)
+    titles = {sheet['properties']['title'] for sheet in metadata.get('sheets', [])}
+    errors = [f"找不到人員分頁：{s}" for s in sorted({it[0] for it in items} - titles)]
+    items = [it for it in items if it[0] in titles]
+    if not items: return 0, errors
+
+    staff = sorted({it[0] for it in items})
+    width = KPI_LAYOUT.max_col + 1
+    n_rows = DAY_LAST_ROW - DAY_FIRST_ROW + 1
+    ranges = [f"{quote_sheet_title(s)}!{a1_range(KPI_FIRST_COL, DAY_FIRST_ROW, KPI_FIRST_COL + width - 1, DAY_LAST_ROW)}" for s in staff]
+    lock_keys = sorted({(file_id, s, DAY_FIRST_ROW + day.day - 1) for s, day, _ in items})
+
+    with ExitStack() as stack:
+        for key in lock_keys: stack.enter_context(get_row_locks().get(key))
+        blocks = {}
+        for s, vr in zip(staff, client.http_client.values_batch_get(file_id, ranges).get('valueRanges', [])):
+            block = np.zeros((n_rows, width))
+            rows = vr.get('values', [])[:n_rows]
+            if rows: block[:len(rows)] = parse_numeric_block(rows, width)
+            blocks[s] = block
+
+        updates = []
+        for s, day, data in items:
+            cells = merged_row_values(blocks[s][day.day - 1], data)
+            updates += _row_span_updates(s, DAY_FIRST_ROW + day.day - 1, cells)
+
+        for i in range(0, len(updates), chunk_ranges):
+            try:
+                client.http_client.values_batch_update(file_id, {"valueInputOption": "RAW", "data": updates[i:i + chunk_ranges]})
+            except Exception as e:
+                return 0, errors + [f"第 {i // chunk_ranges + 1} 批寫入失敗 (前 {i} 個區段已寫入，累加欄位請勿整檔重跑)：{e}"]
+    return len(items), errors
+
+def import_backfill(rows, progress=None, chunk_ranges=BACKFILL_CHUNK_RANGES):
+    """
+    依 (月份, 門市) 分組寫入補登資料：每個月份列表一次資料夾，每個檔案交給 write_backfill_file。
+    progress(已處理列數, 總列數, 已耗時秒) 供畫面顯示吞吐量。
+    回傳 (寫入列數, 錯誤訊息清單)。
+    """
     client, drive_service, _ = get_gspread_client()
-    folder_id = get_working_folder_id(drive_service, root_id, date_obj)
-    filename = f"{date_obj.year}_{date_obj.month:02d}_{store}業績日報表"
-    files = get_sheet_file_info(drive_service, filename, folder_id)
-    target_file = next((f for f in files if "google-apps.spreadsheet" in f['mimeType']), None)
-    if not target_file: return None, f"找不到檔案：{filename}", None
-    try:
-        sh = client.open_by_key(target_file['id'])
-        target_ws = None
-        try: target_ws = sh.worksheet(store)
-        except:
-            try: target_ws = sh.worksheet("總表")
-            except: pass
-        if target_ws:
-            data = target_ws.get_all_values()
-            if len(data) > 1:
-                clean_headers = make_columns_unique(data[0])
-                df = pd.DataFrame(data[1:], columns=clean_headers)
-            else: df = pd.DataFrame(data)
-            return df, filename, target_file['webViewLink']
-        else: return None, "找不到店名或總表分頁", target_file['webViewLink']
-    except Exception as e: return None, str(e), None
-
-# --- 3. 組織定義 ---
-STORE_NAMES = [
-    "(ALL) 全店總表",
-    "文賢店", "東門店", "永康店", "歸仁店", "安中店",
-    "小西門店", "鹽行店", "五甲店", "鳳山店"
-]
+    t0 = time.perf_counter()
+    by_file = {}
+    for store, staff, day, data in rows:
+        by_file.setdefault((day.strftime('%Y_%m'), store), []).append((staff, day, data))
+
+    month_files, written, processed, errors = {}, 0, 0, []
+    for (month_key, store), items in by_file.items():
+        if month_key not in month_files:
+            try: month_files[month_key] = {store_name_from_file(f): f for f in list_month_store_files(drive_service, items[0][1])}
+            except Exception as e:
+                month_files[month_key] = {}
+                errors.append(f"{month_key} 無法讀取資料夾：{e}")
+        target_file = month_files[month_key].get(store)
+        if not target_file: errors.append(f"找不到檔案：{month_key}_{store}業績日報表")
+        else:
+            try:
+                n, errs = write_backfill_file(client, target_file['id'], items, chunk_ranges)
+                written += n
+                errors += [f"{month_key} {store}：{e}" for e in errs]
+            except Exception as e: errors.append(f"{month_key} {store}：{e}")
+        processed += len(items)
+        if progress: progress(processed, len(rows), time.perf_counter() - t0)
+    return written, errors
+
+# --- 3. 組織定義 (STORE_NAMES 定義於 kpi_core，假後端與壓力測試共用) ---
+
+@st.cache_resource
+def get_roster_warmer():
+    warmer = RosterWarmer([s for s in STORE_NAMES if s != "(ALL) 全店總表"], ROSTER_REFRESH_SECONDS)
+    warmer.start()
+    return warmer
+
+roster_warmer = get_roster_warmer()
 
 # --- 4. 介面邏輯 ---
 
@@ -321,16 +286,34 @@ if selected_store == "(ALL) 全店總表":
     staff_options = []
 else:
     view_date = st.sidebar.date_input("設定工作月份", date.today(), key="sidebar_date_picker")
-    with st.spinner("讀取人員名單..."):
-        dynamic_staff = fetch_dynamic_staff_list(selected_store, view_date)
+    with st.spinner("讀取人員名單..."), trace_action("載入人員名單"):
+        try: dynamic_staff, staff_error = fetch_dynamic_staff_list(selected_store, view_date), None
+        except Exception as e: dynamic_staff, staff_error = [], e
     
     if dynamic_staff: staff_options = ["該店總表"] + dynamic_staff
     else:
         staff_options = ["該店總表"]
-        st.sidebar.caption("⚠️ 尚未建立該月檔案或讀取失敗")
+        if staff_error: st.sidebar.error(f"🔴 人員名單讀取失敗：{staff_error}")
+        else: st.sidebar.caption("⚠️ 尚未建立該月檔案")
     selected_user = st.sidebar.selectbox("請選擇人員", staff_options, key="sidebar_user_select")
 
 st.sidebar.markdown("---")
+write_queue, _ = get_write_queue()
+queue_counts = write_queue.counts()
+with st.sidebar.expander(f"📮 上傳佇列 (待寫入 {queue_counts.get('pending', 0)}・失敗 {queue_counts.get('failed', 0)})", expanded=False):
+    st.caption(f"已完成 {queue_counts.get('done', 0)} 筆")
+    # 明細含人員、日期與錯誤訊息：管理員看全部並可重試，門市登入後只看自己門市，未登入只顯示筆數
+    if st.session_state.admin_logged_in or st.session_state.authenticated_store:
+        pending_df = write_queue.items()
+        if not st.session_state.admin_logged_in:
+            pending_df = pending_df[pending_df["門市"] == st.session_state.authenticated_store]
+        if pending_df.empty: st.caption("目前沒有待處理項目")
+        else: st.dataframe(pending_df, hide_index=True, use_container_width=True)
+        if st.session_state.admin_logged_in and queue_counts.get('failed') and st.button("🔁 重試失敗項目"):
+            write_queue.retry_failed()
+            st.rerun()
+    else: st.caption("登入後可查看明細")
+
 with st.sidebar.expander("⚙️ 系統資訊", expanded=False):
     st.markdown("""
     **馬尼門市業績戰情表**
@@ -339,12 +322,33 @@ with st.sidebar.expander("⚙️ 系統資訊", expanded=False):
     * 系統優先讀取 Google Drive 上的 `system_kpi_config` 設定檔。
     * 若無設定檔，則使用內建的 v15.6 預設值。
     """)
+    config_cache = get_config_cache()
+    st.caption(f"🧩 設定檔來源：{'雲端' if config_cache.source == 'cloud' else '內建預設'}・{len(KPI_CONFIG)} 項 KPI・上次讀取 {config_cache.load_seconds*1000:.0f} ms")
+    for w in config_cache.warnings: st.caption(f"⚠️ {w}")
+    paint_slot = st.empty()
     if st.button("🔄 重新載入設定檔"):
-        st.session_state.kpi_config = None
+        config_cache.invalidate()
+        st.rerun()
+    idx_stats = get_drive_index().stats()
+    st.caption(f"🗂️ 檔案索引：{idx_stats['folders']} 個資料夾 / {idx_stats['files']} 個檔案・命中 {idx_stats['hits']}・未命中 {idx_stats['misses']}・TTL {idx_stats['ttl']} 秒")
+    api_stats = get_api_guard().stats()
+    st.caption(f"🚦 API 呼叫 {api_stats['calls']} 次・限流等待 {api_stats['throttled']}・重試 {api_stats['retried']}・失敗 {api_stats['failed']}")
+    if roster_warmer.last_run:
+        st.caption(f"👥 人員名單預載：{len(get_roster_cache())} 筆・{roster_warmer.last_run:%H:%M:%S} 更新・耗時 {roster_warmer.last_seconds:.1f}s")
+        if roster_warmer.last_errors: st.caption(f"⚠️ 名單預載失敗：{', '.join(roster_warmer.last_errors)}")
+    snap = get_snapshot_cache().stats()
+    st.caption(f"📦 快照快取：{snap['entries']} 筆・{snap['bytes']/1024/1024:.1f} / {snap['max_bytes']/1024/1024:.0f} MB・命中 {snap['hits']}・未命中 {snap['misses']}・合併請求 {snap['collapsed']}・淘汰 {snap['evictions']}")
+    if st.button("🗂️ 重新整理檔案索引"):
+        get_drive_index().invalidate()
         st.rerun()
 
 st.title(f"📊 {selected_store} - {selected_user}")
 
+# 首次繪製時間：從腳本開始到側邊欄與標題繪出為止 (每個 session 的第一次執行另外記錄)
+run_ms = (time.perf_counter() - _RUN_STARTED) * 1000
+if 'first_paint_ms' not in st.session_state: st.session_state.first_paint_ms = run_ms
+paint_slot.caption(f"⏱️ 首次繪製 {st.session_state.first_paint_ms:.0f} ms（本 session 第一次載入）・本次 {run_ms:.0f} ms")
+
 def check_store_auth(current_store):
     if current_store == "(ALL) 全店總表":
         if st.session_state.admin_logged_in: return True
@@ -374,78 +378,278 @@ if not check_store_auth(selected_store): st.stop()
 
 if selected_store == "(ALL) 全店總表":
     st.markdown("### 🏆 全公司業績戰情室")
-    view_date = st.date_input("選擇檢視月份", date.today(), key="main_date_input")
+    d_col, w_col = st.columns([3, 1])
+    view_date = d_col.date_input("選擇檢視月份", date.today(), key="main_date_input")
+    scan_workers = w_col.number_input("並行讀取數", min_value=1, max_value=32, value=SCAN_MAX_WORKERS, step=1)
+    full_rescan = st.checkbox("強制完整重新掃描 (忽略未變動門市的快取)", value=False)
+    month_key = view_date.strftime('%Y%m')
     
     if st.button("🔄 掃描並彙整全店數據", type="primary", use_container_width=True):
-        with st.spinner(f"正在掃描 {view_date.strftime('%Y%m')} 資料..."):
-            df_all, msg = scan_and_aggregate_stores(view_date)
-            if df_all is not None and not df_all.empty:
-                st.success(msg)
-                
-                total_profit = df_all["毛利"].sum()
-                total_cases = df_all["門號"].sum()
-                store_count = len(df_all)
-                
-                m1, m2, m3 = st.columns(3)
-                m1.metric("全店總毛利", f"${total_profit:,.0f}", border=True)
-                m2.metric("全店總門號", f"{total_cases:.0f} 件", border=True)
-                m3.metric("營業門市數", f"{store_count} 間", border=True)
-                
-                st.divider()
-
-                tab1, tab2, tab3, tab4, tab5 = st.tabs([
-                    "💰 財務概況", "🎯 重點目標", "🤝 顧客經營", "📡 遠傳專案", "📋 詳細報表"
-                ])
-                
-                with tab1:
-                    c1, c2, c3 = st.columns(3)
-                    c1.metric("保險營收", f"${df_all['保險營收'].sum():,.0f}")
-                    c2.metric("配件營收", f"${df_all['配件營收'].sum():,.0f}")
-                    
-                with tab2:
-                    st.caption("含硬體銷售與推廣目標")
-                    target_cols = [k for k, v in KPI_CONFIG.items() if v['cat'] in ['hardware', 'target']]
-                    cols = st.columns(4)
-                    for i, key in enumerate(target_cols):
-                        with cols[i % 4]:
-                            val = df_all[key].sum()
-                            label = KPI_CONFIG[key]['label']
-                            display_label = label.split(" (")[0]
-                            st.metric(display_label, f"{val:,.0f}")
-                            
-                with tab3:
-                    c1, c2, c3 = st.columns(3)
-                    c1.metric("生活圈", f"{df_all['生活圈'].sum():.0f}")
-                    c2.metric("Google 評論", f"{df_all['GOOGLE 評論'].sum():.0f}")
-                    c3.metric("來客數", f"{df_all['來客數'].sum():.0f}")
-                    
-                with tab4:
-                    c1, c2, c3, c4 = st.columns(4)
-                    c1.metric("遠傳續約", f"{df_all['遠傳續約'].sum():.0f}")
-                    c2.metric("續約 GAP", f"{df_all['遠傳續約累積GAP'].sum():.0f}")
-                    
-                    avg_up = df_all[df_all["遠傳升續率"]>0]["遠傳升續率"].mean()
-                    c3.metric("升續率", f"{avg_up*100:.1f}%" if not pd.isna(avg_up) else "0%")
-                    
-                    avg_flat = df_all[df_all["遠傳平續率"]>0]["遠傳平續率"].mean()
-                    c4.metric("平續率", f"{avg_flat*100:.1f}%" if not pd.isna(avg_flat) else "0%")
+        with st.spinner(f"正在掃描 {month_key} 資料..."), trace_action("全店掃描"):
+            df_all, msg = scan_and_aggregate_stores(view_date, max_workers=scan_workers, use_cache=not full_rescan)
+            if df_all is None or df_all.empty: st.error(msg)
+
+    # 排程寫入的快照比目前快取的結果新時直接載入 (只讀一個小檔比對時間)
+    snapshot_info = latest_snapshot_info(SNAPSHOT_DIR, month_key)
+    scan_result = get_cube_cache().get(month_key)
+    if snapshot_info and (scan_result is None or snapshot_info['created_at'] > scan_result['scanned_at']):
+        snapshot = load_latest_snapshot(SNAPSHOT_DIR, month_key, kpi_config_key(KPI_CONFIG))
+        if snapshot: get_cube_cache()[month_key] = scan_result = snapshot
+
+    # 畫面一律由共用快取中的最近一次掃描結果繪製，切換分頁或 rerun 不需重新讀取
+    if scan_result:
+        df_all, cube = scan_result['df'], scan_result['cube']
+        st.success(scan_result['msg'])
+        scanned_at = datetime.fromtimestamp(scan_result['scanned_at'])
+        if scan_result.get('source') == 'snapshot':
+            age_min = (time.time() - scan_result['scanned_at']) / 60
+            age = f"{age_min:.0f} 分鐘前" if age_min < 120 else f"{age_min / 60:.1f} 小時前"
+            st.info(f"📦 排程快照：{scanned_at:%Y-%m-%d %H:%M:%S}（{age}）・按「🔄 掃描並彙整全店數據」可即時重新讀取")
+        st.caption(f"資料時間：{scanned_at:%Y-%m-%d %H:%M:%S}・每日明細 {cube.nbytes/1024:.0f} KB")
+        scan_stats = df_all.attrs.get('scan_stats')
+        if scan_stats:
+            with st.expander("⏱️ 掃描耗時明細", expanded=False):
+                time_df = pd.DataFrame(
+                    [{"門市": k, "讀取秒數": round(v, 2), "狀態": scan_stats['errors'].get(k, "OK")}
+                     for k, v in scan_stats['store_times'].items()],
+                    columns=["門市", "讀取秒數", "狀態"],
+                ).sort_values("讀取秒數", ascending=False)
+                st.caption(f"總耗時 {scan_stats['wall_time']:.2f} 秒・並行 {scan_stats['workers']}・各店讀取合計 {sum(scan_stats['store_times'].values()):.2f} 秒・沿用快取 {scan_stats['from_cache']} 間")
+                st.dataframe(time_df, use_container_width=True, hide_index=True)
+        
+        total_profit = df_all["毛利"].sum()
+        total_cases = df_all["門號"].sum()
+        store_count = len(df_all)
+        
+        m1, m2, m3 = st.columns(3)
+        m1.metric("全店總毛利", f"${total_profit:,.0f}", border=True)
+        m2.metric("全店總門號", f"{total_cases:.0f} 件", border=True)
+        m3.metric("營業門市數", f"{store_count} 間", border=True)
+        
+        st.divider()
+
+        tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs([
+            "💰 財務概況", "🎯 重點目標", "🤝 顧客經營", "📡 遠傳專案", "📈 每日趨勢", "📋 詳細報表"
+        ])
+        
+        with tab1:
+            c1, c2, c3 = st.columns(3)
+            c1.metric("保險營收", f"${df_all['保險營收'].sum():,.0f}")
+            c2.metric("配件營收", f"${df_all['配件營收'].sum():,.0f}")
+            
+        with tab2:
+            st.caption("含硬體銷售與推廣目標")
+            target_cols = KPI_LAYOUT.by_cat('hardware', 'target')
+            cols = st.columns(4)
+            for i, key in enumerate(target_cols):
+                with cols[i % 4]:
+                    val = df_all[key].sum()
+                    label = KPI_CONFIG[key]['label']
+                    display_label = label.split(" (")[0]
+                    st.metric(display_label, f"{val:,.0f}")
                     
-                with tab5:
-                    column_cfg = {
-                        "門市": st.column_config.TextColumn("門市名稱", disabled=True),
-                        "毛利": st.column_config.ProgressColumn("毛利", format="$%d", min_value=0, max_value=int(total_profit/2) if total_profit > 0 else 1000),
-                        "連結": st.column_config.LinkColumn("檔案連結", display_text="🔗 開啟")
-                    }
-                    st.dataframe(df_all, column_config=column_cfg, use_container_width=True, hide_index=True)
-            else: st.error(msg)
+        with tab3:
+            c1, c2, c3 = st.columns(3)
+            c1.metric("生活圈", f"{df_all['生活圈'].sum():.0f}")
+            c2.metric("Google 評論", f"{df_all['GOOGLE 評論'].sum():.0f}")
+            c3.metric("來客數", f"{df_all['來客數'].sum():.0f}")
+            
+        with tab4:
+            c1, c2, c3, c4 = st.columns(4)
+            c1.metric("遠傳續約", f"{df_all['遠傳續約'].sum():.0f}")
+            c2.metric("續約 GAP", f"{df_all['遠傳續約累積GAP'].sum():.0f}")
+            
+            avg_up = df_all[df_all["遠傳升續率"]>0]["遠傳升續率"].mean()
+            c3.metric("升續率", f"{avg_up*100:.1f}%" if not pd.isna(avg_up) else "0%")
+            
+            avg_flat = df_all[df_all["遠傳平續率"]>0]["遠傳平續率"].mean()
+            c4.metric("平續率", f"{avg_flat*100:.1f}%" if not pd.isna(avg_flat) else "0%")
+
+        with tab5:
+            import plotly.express as px
+            trend_kpi = st.selectbox("指標", cube.kpis, format_func=lambda k: KPI_CONFIG[k]['label'], key="trend_kpi")
+            daily_total = cube.daily_total(trend_kpi)
+            # 本月只計算到今天，過去月份以整月計算
+            elapsed_days = min(date.today().day, len(cube.days)) if month_key == date.today().strftime('%Y%m') else len(cube.days)
+            to_date = daily_total.iloc[:elapsed_days]
+            
+            t1, t2, t3 = st.columns(3)
+            if KPI_CONFIG[trend_kpi].get('mode') == 'overwrite':
+                t1.metric("期間平均", f"{to_date[to_date != 0].mean() if (to_date != 0).any() else 0:,.2f}")
+            else:
+                t1.metric("每日平均", f"{to_date.mean() if elapsed_days else 0:,.1f}")
+                t2.metric("月底推估", f"{to_date.sum() / elapsed_days * len(cube.days) if elapsed_days else 0:,.0f}")
+            if to_date.any(): t3.metric("最佳日", f"{int(to_date.idxmax())} 日", f"{to_date.max():,.0f}")
+            
+            fig = px.line(daily_total.rename("全店").reset_index(), x="日", y="全店", markers=True, title=f"{KPI_CONFIG[trend_kpi]['label']}・全店每日趨勢")
+            st.plotly_chart(fig, use_container_width=True)
+            by_store = cube.daily_by_store(trend_kpi).reset_index().melt(id_vars="日", var_name="門市", value_name="數值")
+            st.plotly_chart(px.line(by_store, x="日", y="數值", color="門市", title="各店每日"), use_container_width=True)
+            
+            rank_day = st.slider("單日排行日期", 1, len(cube.days), max(elapsed_days, 1), key="rank_day")
+            st.dataframe(cube.day_ranking(rank_day, trend_kpi), use_container_width=True, hide_index=True)
+            
+        with tab6:
+            column_cfg = {
+                "門市": st.column_config.TextColumn("門市名稱", disabled=True),
+                "毛利": st.column_config.ProgressColumn("毛利", format="$%d", min_value=0, max_value=int(total_profit/2) if total_profit > 0 else 1000),
+                "連結": st.column_config.LinkColumn("檔案連結", display_text="🔗 開啟")
+            }
+            st.dataframe(df_all, column_config=column_cfg, use_container_width=True, hide_index=True)
+
+    st.divider()
+    st.markdown("#### 👥 全公司人員排行榜")
+    if st.button("👥 讀取各店人員分頁並排行", use_container_width=True):
+        with st.spinner(f"正在讀取 {month_key} 人員資料..."), trace_action("人員排行掃描"):
+            df_staff, msg = scan_staff_leaderboard(view_date, max_workers=scan_workers, use_cache=not full_rescan)
+            if df_staff is None: st.error(msg)
+
+    staff_result = get_staff_cache().get(month_key)
+    if staff_result:
+        df_staff = staff_result['df']
+        st.success(staff_result['msg'])
+        rank_kpi = st.selectbox("排行指標", KPI_LAYOUT.keys, format_func=lambda k: KPI_CONFIG[k]['label'], key="staff_rank_kpi")
+        leaderboard = df_staff.sort_values(rank_kpi, ascending=False).reset_index(drop=True)
+        leaderboard.insert(0, "名次", np.arange(1, len(leaderboard) + 1))
+        st.dataframe(leaderboard[["名次", "門市", "人員", rank_kpi] + [k for k in KPI_LAYOUT.keys if k != rank_kpi]],
+                     use_container_width=True, hide_index=True)
+
+    st.markdown("#### 📤 匯出整月明細")
+    # 優先沿用本程序的掃描結果；沒有時改由本機歷史資料庫串流讀取，都不會再呼叫 API
+    export_staff = get_staff_cache().get(month_key)
+    export_cube = get_cube_cache().get(month_key)
+    if export_staff:
+        export_source = f"人員排行掃描結果（{datetime.fromtimestamp(export_staff['scanned_at']):%H:%M:%S}）"
+        # 欄位順序以人員掃描結果為準；門市總表 cube 的 KPI 順序不同 (兩次掃描之間改過設定) 時不匯出門市總表
+        export_kpis = list(export_staff['df'].columns[2:])
+        cube_for_export = export_cube['cube'] if export_cube and export_cube['cube'].kpis == export_kpis else None
+        if export_cube and cube_for_export is None:
+            st.warning("⚠️ 全店掃描與人員掃描的 KPI 欄位不一致 (設定檔已變更)，匯出將略過門市總表，請重新掃描全店")
+        export_rows = lambda: iter_cached_month_rows(cube_for_export, export_staff['daily'])
+    elif month_key in set(get_kpi_history().months()['month']):
+        export_source = "本機歷史資料庫"
+        export_kpis = KPI_LAYOUT.keys
+        export_rows = lambda: get_kpi_history().iter_month_rows(month_key, export_kpis)
+    else:
+        export_rows = None
+        st.caption("請先執行「👥 讀取各店人員分頁並排行」或匯入歷史資料後再匯出")
+
+    if export_rows:
+        export_labels = [KPI_CONFIG[k]['label'] if k in KPI_CONFIG else k for k in export_kpis]
+
+        def build_xlsx():
+            out = tempfile.TemporaryFile()
+            export_month_xlsx(out, month_key, export_kpis, export_labels, export_rows())
+            out.seek(0)
+            return out
+
+        def build_csv():
+            out = tempfile.TemporaryFile()
+            text = io.TextIOWrapper(out, encoding="utf-8", newline="")
+            export_month_csv(text, month_key, export_kpis, export_labels, export_rows())
+            text.flush()
+            text.detach()
+            out.seek(0)
+            return out
+
+        st.caption(f"資料來源：{export_source}・每間門市一個工作表，含門市總表與每位人員的每日數值・按下按鈕時才產生檔案")
+        x_col, c_col = st.columns(2)
+        x_col.download_button("📊 下載 Excel (每店一個工作表)", data=build_xlsx, file_name=f"{month_key}_全店人員每日明細.xlsx",
+                              mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", use_container_width=True)
+        c_col.download_button("🧾 下載 CSV", data=build_csv, file_name=f"{month_key}_全店人員每日明細.csv",
+                              mime="text/csv", use_container_width=True)
+
+    st.markdown("---")
+    st.markdown("#### 🗄️ 多月趨勢（本機歷史資料）")
+    history = get_kpi_history()
+    h_col1, h_col2 = st.columns([3, 1])
+    months_back = h_col2.number_input("月數", min_value=2, max_value=24, value=6, step=1)
+    history_months = [(view_date.replace(day=1) - pd.DateOffset(months=i)).strftime('%Y%m') for i in range(int(months_back) - 1, -1, -1)]
+    h_col1.caption(f"區間 {history_months[0]} ~ {history_months[-1]}・已結帳的月份匯入一次後即由本機查詢，不再讀取試算表")
+    if st.button("📥 匯入缺少或進行中的月份", use_container_width=True):
+        with st.spinner("匯入歷史資料..."), trace_action("匯入歷史資料"):
+            for m in history_months:
+                _, ingest_msg = ingest_month(history, datetime.strptime(m, '%Y%m').date(), scan_workers,
+                                             SCAN_COLUMN_PROJECTION, grace_days=HISTORY_GRACE_DAYS)
+                st.caption(ingest_msg)
+
+    stored_months = history.months()
+    stored_months = stored_months[stored_months['month'].between(history_months[0], history_months[-1])]
+    if stored_months.empty: st.caption("區間內尚無歷史資料")
+    else:
+        st.caption(f"本機已有 {len(stored_months)} 個月份（{int(stored_months['closed'].sum())} 個已結帳）")
+        hist_kpi = st.selectbox("趨勢指標", KPI_LAYOUT.keys, format_func=lambda k: KPI_CONFIG[k]['label'], key="history_kpi")
+        h_tab1, h_tab2, h_tab3 = st.tabs(["📈 各店月趨勢", "📊 月增減", "🔁 滾動加總"])
+        totals, delta, pct = history.month_over_month(hist_kpi, history_months[0], history_months[-1])
+        with h_tab1:
+            st.line_chart(totals)
+        with h_tab2:
+            if len(totals) < 2: st.caption("至少需要兩個月份")
+            else:
+                mom = pd.DataFrame({"本月": totals.iloc[-1], "上月": totals.iloc[-2], "增減": delta.iloc[-1], "成長率 (%)": pct.iloc[-1] * 100})
+                st.caption(f"{totals.index[-1]} 對 {totals.index[-2]}")
+                st.dataframe(mom.sort_values("增減", ascending=False), use_container_width=True)
+        with h_tab3:
+            window = st.slider("滾動天數", 3, 30, 7, key="history_window")
+            st.line_chart(history.rolling(hist_kpi, history_months[0], history_months[-1], window=window))
+
+    st.markdown("---")
+    with st.expander("📥 批次補登匯入 (Excel / CSV)", expanded=False):
+        st.caption(f"欄位：{'、'.join(BACKFILL_KEY_COLUMNS)}，以及任意 KPI 欄位 (代號或顯示名稱)。空白儲存格不寫入；累加欄位會加到現有數值上，覆寫欄位直接取代。")
+        backfill_file = st.file_uploader("上傳補登檔", type=["xlsx", "csv"], key="backfill_upload")
+        if backfill_file is not None:
+            try: backfill_df = load_backfill_file(backfill_file)
+            except Exception as e: backfill_df = None; st.error(f"❌ 無法讀取檔案：{e}")
+            if backfill_df is not None:
+                backfill_rows, backfill_errors = validate_backfill_rows(backfill_df, STORE_NAMES)
+                n_files = len({(day.strftime('%Y_%m'), store) for store, _, day, _ in backfill_rows})
+                st.info(f"可匯入 {len(backfill_rows)} 列 (共 {n_files} 個檔案)・問題 {len(backfill_errors)} 項")
+                if backfill_errors: st.dataframe(pd.DataFrame({"問題": backfill_errors}), hide_index=True, use_container_width=True)
+                if backfill_rows and st.button("🚀 開始匯入", type="primary"):
+                    bar = st.progress(0, text="匯入中...")
+                    def show_progress(done, total, elapsed):
+                        bar.progress(done / total, text=f"已處理 {done}/{total} 列・{done / max(elapsed, 1e-9):.0f} 列/秒")
+                    with trace_action("批次補登匯入"):
+                        written, import_errors = import_backfill(backfill_rows, progress=show_progress)
+                    if import_errors:
+                        st.warning(f"⚠️ 已寫入 {written} 列，{len(import_errors)} 項失敗")
+                        st.dataframe(pd.DataFrame({"錯誤": import_errors}), hide_index=True, use_container_width=True)
+                    else: st.success(f"✅ 已寫入 {written} 列")
+
+    with st.expander("🔬 API 呼叫追蹤", expanded=False):
+        tracer = get_api_tracer()
+        trace_df = tracer.frame()
+        if trace_df.empty: st.caption("目前沒有 API 呼叫紀錄")
+        else:
+            st.caption(f"最近 {len(trace_df)} 筆呼叫 (最多保留 {tracer.max_events} 筆)・自 {datetime.fromtimestamp(trace_df['ts'].min()):%m-%d %H:%M:%S} 起・耗時含限流等待與重試")
+            by_action = summarize_trace(trace_df)
+            st.dataframe(by_action, use_container_width=True)
+            trace_pick = st.selectbox("動作明細", by_action.index, key="trace_action")
+            picked = trace_df[trace_df['action'] == trace_pick]
+            st.dataframe(summarize_trace(picked, by="op").drop(columns="觸發次數"), use_container_width=True)
+            st.caption("最慢的 20 次呼叫")
+            st.dataframe(picked.nlargest(20, 'latency_ms')[["op", "target", "latency_ms", "attempts", "response_bytes", "outcome", "thread"]],
+                         use_container_width=True, hide_index=True)
+
+            def build_trace_jsonl():
+                buf = io.StringIO()
+                tracer.write_jsonl(buf)
+                return buf.getvalue().encode("utf-8")
+            t_col1, t_col2 = st.columns(2)
+            t_col1.download_button("📄 下載追蹤紀錄 (JSON Lines)", data=build_trace_jsonl, file_name=f"api_trace_{datetime.now():%Y%m%d_%H%M%S}.jsonl",
+                                   mime="application/jsonl", use_container_width=True)
+            if t_col2.button("🧹 清除追蹤紀錄", use_container_width=True):
+                tracer.clear()
+                st.rerun()
 
 elif selected_user == "該店總表":
     st.markdown("### 📥 門市報表檢視中心")
     st.info(f"目前設定工作月份：**{view_date.strftime('%Y年%m月')}**")
     if st.button(f"📂 讀取 {selected_store} 總表", use_container_width=True):
-        with st.spinner("讀取中..."):
+        with st.spinner("讀取中..."), trace_action("讀取門市總表"):
             df, fname, link = read_sheet_robust_v13(selected_store, view_date)
             if df is not None:
+                # 只保存共用快照的參照，不另外複製一份
                 st.session_state.current_excel_file = {'df': df, 'name': fname, 'link': link}
                 st.success("讀取成功")
             else: st.error(fname)
@@ -454,6 +658,7 @@ elif selected_user == "該店總表":
         f = st.session_state.current_excel_file
         st.subheader(f['name'])
         st.link_button("🔗 開啟試算表", f['link'])
+        st.caption(f"{len(f['df'])} 列 × {len(f['df'].columns)} 欄・記憶體 {f['df'].memory_usage(deep=True).sum()/1024:.1f} KB")
         st.dataframe(f['df'], use_container_width=True)
 
 else:
@@ -467,14 +672,14 @@ else:
         
         # 動態生成表單
         st.subheader("💰 財務與門號")
-        fin_items = [k for k,v in KPI_CONFIG.items() if v['cat'] == 'finance']
+        fin_items = KPI_LAYOUT.groups.get('finance', [])
         cols = st.columns(len(fin_items))
         inputs = {}
         for i, key in enumerate(fin_items):
             inputs[key] = cols[i].number_input(KPI_CONFIG[key]['label'], min_value=0, step=1 if KPI_CONFIG[key]['type']=='int' else 100)
 
         st.subheader("🎯 重點目標銷售")
-        tgt_items = [k for k,v in KPI_CONFIG.items() if v['cat'] in ['hardware', 'target']]
+        tgt_items = KPI_LAYOUT.by_cat('hardware', 'target')
         for i in range(0, len(tgt_items), 4):
             batch = tgt_items[i:i+4]
             cols = st.columns(4)
@@ -482,13 +687,13 @@ else:
                 inputs[key] = cols[j].number_input(KPI_CONFIG[key]['label'], min_value=0, step=1)
         
         st.subheader("🤝 顧客經營")
-        svc_items = [k for k,v in KPI_CONFIG.items() if v['cat'] == 'service']
+        svc_items = KPI_LAYOUT.groups.get('service', [])
         cols = st.columns(len(svc_items))
         for i, key in enumerate(svc_items):
             inputs[key] = cols[i].number_input(KPI_CONFIG[key]['label'], min_value=0, step=1)
 
         st.subheader("📡 遠傳專案指標")
-        prj_items = [k for k,v in KPI_CONFIG.items() if v['cat'] == 'project']
+        prj_items = KPI_LAYOUT.groups.get('project', [])
         cols = st.columns(len(prj_items))
         for i, key in enumerate(prj_items):
             if KPI_CONFIG[key]['type'] == 'percent':
@@ -0,0 +1,168 @@
+"""
+離線基準測試：以假後端 (fake_backend) 量測全店掃描、門市總表讀取與上傳佇列寫入的
+耗時、API 呼叫次數與峰值記憶體，不需要 Google 帳號也不會呼叫真實 API。
+
+    python benchmark.py                                # 10 / 100 / 1000 間門市，全部情境
+    python benchmark.py --stores 10 100 --scenarios scan read --latency-ms 20
+    python benchmark.py --json bench.json              # 結果存成 JSON
+    python benchmark.py --baseline bench.json          # 與先前結果比對，退步時結束代碼為 1
+
+情境：
+    scan        全店掃描 (scan_month_stores，介面的 scan_and_aggregate_stores 即呼叫它)，不使用快取
+    scan-warm   第二次全店掃描 (檔案未變動，沿用掃描快取)
+    scan-staff  人員分頁掃描 (scan_month_staff)
+    read        逐店讀取門市總表 (read_sheet_robust_v13)
+    write       每店送出一筆日報 (update_google_sheet_robust)，計時到上傳佇列全部寫完為止
+
+每個 (情境, 門市數) 在獨立的子程序中執行，彼此的快取與峰值記憶體互不影響。
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date
+
+SCENARIOS = ["scan", "scan-warm", "scan-staff", "read", "write"]
+
+def _status_mb(field):
+    """/proc/self/status 的 VmRSS / VmHWM (MB)；非 Linux 時以 ru_maxrss 代替。"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"): return int(line.split()[1]) / 1024
+    except OSError: pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _reset_peak_rss():
+    """把 VmHWM 重設為目前的 RSS (Linux)，讓峰值只反映之後的操作。"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f: f.write("5")
+    except OSError: pass
+
+def run_scenario(scenario, stores, staff, workers, latency_ms, error_rate, seed, quota):
+    """在目前的程序中建立假後端並執行一個情境，回傳結果 dict。"""
+    import kpi_core
+    workdir = tempfile.mkdtemp(prefix="kpi-bench-")
+    kpi_core.configure({
+        "KPI_BACKEND": "fake", "TARGET_FOLDER_ID": "fake-root", "FAKE_STORES": stores, "FAKE_STAFF": staff,
+        "FAKE_MONTHS": 1, "FAKE_LATENCY_MS": latency_ms, "FAKE_QUOTA_ERROR_RATE": error_rate, "FAKE_SEED": seed,
+        "SHEETS_QUOTA_PER_MINUTE": quota, "DRIVE_QUOTA_PER_MINUTE": quota, "API_TRACE_MAX_EVENTS": 10 ** 7,
+        "WRITE_QUEUE_PATH": os.path.join(workdir, "write_queue.sqlite3"), "SNAPSHOT_CACHE_MB": 4096,
+    })
+    import fake_backend
+
+    t0 = time.perf_counter()
+    store_names = fake_backend.get_fake_backend().world.store_names
+    kpi_core.load_system_config()
+    setup_seconds = time.perf_counter() - t0
+    today = date.today()
+    if scenario == "scan-warm": kpi_core.scan_month_stores(today, workers, use_cache=False)
+    if scenario == "write": queue, _ = kpi_core.get_write_queue()
+
+    tracer = kpi_core.get_api_tracer()
+    tracer.clear()
+    rss_before = _status_mb("VmRSS")
+    _reset_peak_rss()
+    t0 = time.perf_counter()
+    errors = 0
+    if scenario in ("scan", "scan-warm"):
+        df, _, _ = kpi_core.scan_month_stores(today, workers, use_cache=scenario == "scan-warm")
+        errors = len(df.attrs['scan_stats']['errors']) if df is not None else stores
+    elif scenario == "scan-staff":
+        df, _, _ = kpi_core.scan_month_staff(today, workers, use_cache=False)
+        errors = len(df.attrs['scan_stats']['errors']) if df is not None else stores
+    elif scenario == "read":
+        errors = sum(kpi_core.read_sheet_robust_v13(store, today)[0] is None for store in store_names)
+    elif scenario == "write":
+        for i, store in enumerate(store_names):
+            kpi_core.update_google_sheet_robust(store, f"人員{i % staff + 1:02d}", today, {"毛利": 1000, "門號": 1})
+        enqueue_seconds = time.perf_counter() - t0
+        while queue.counts().get('pending'): time.sleep(0.02)
+        errors = queue.counts().get('failed', 0)
+    wall = time.perf_counter() - t0
+    peak = _status_mb("VmHWM") - rss_before
+
+    trace = tracer.frame()
+    by_op = trace.groupby("op").size().to_dict() if not trace.empty else {}
+    result = {
+        "scenario": scenario, "stores": stores, "staff": staff, "latency_ms": latency_ms, "error_rate": error_rate,
+        "setup_s": round(setup_seconds, 3), "wall_s": round(wall, 3),
+        "api_calls": int(len(trace)), "sheets_calls": int((trace["api"] == "sheets").sum()),
+        "drive_calls": int((trace["api"] == "drive").sum()), "retries": int((trace["attempts"] - 1).sum()),
+        "p95_call_ms": float(trace["latency_ms"].quantile(0.95)) if len(trace) else 0.0,
+        "peak_mb": round(max(peak, 0.0), 1), "errors": int(errors), "by_op": {k: int(v) for k, v in by_op.items()},
+    }
+    if scenario == "write": result["enqueue_ms_per_submit"] = round(enqueue_seconds / stores * 1000, 2)
+    return result
+
+def run_in_subprocess(params):
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", json.dumps(params)],
+                         capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    lines = [l for l in out.stdout.splitlines() if l.startswith("{")]
+    if out.returncode or not lines:
+        raise RuntimeError(f"{params['scenario']} / {params['stores']} 間門市執行失敗：\n{out.stderr[-2000:]}")
+    return json.loads(lines[-1])
+
+def compare(results, baseline, tolerance):
+    """API 呼叫數增加，或耗時超過基準 (1 + tolerance) 倍且多出 50 ms 以上，視為退步。"""
+    base = {(r["scenario"], r["stores"]): r for r in baseline}
+    problems = []
+    for r in results:
+        b = base.get((r["scenario"], r["stores"]))
+        if not b: continue
+        label = f"{r['scenario']} / {r['stores']} 間門市"
+        if r["api_calls"] > b["api_calls"]: problems.append(f"{label}：API 呼叫 {b['api_calls']} → {r['api_calls']}")
+        if r["wall_s"] > b["wall_s"] * (1 + tolerance) and r["wall_s"] - b["wall_s"] > 0.05:
+            problems.append(f"{label}：耗時 {b['wall_s']:.2f}s → {r['wall_s']:.2f}s")
+    return problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="以假後端離線量測掃描 / 讀取 / 寫入效能")
+    parser.add_argument("--stores", type=int, nargs="+", default=[10, 100, 1000], help="門市數 (可多個)")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--staff", type=int, default=5, help="每間門市的人員分頁數")
+    parser.add_argument("--workers", type=int, default=8, help="掃描並行讀取數")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="每次 API 請求的模擬延遲")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="每次 API 請求回傳 429 的機率")
+    parser.add_argument("--quota", type=int, default=10 ** 9, help="ApiGuard 每分鐘配額 (預設不限流)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="結果輸出路徑")
+    parser.add_argument("--baseline", help="先前的 --json 結果，用來檢查退步")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="耗時容許增加的比例")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run_scenario(**json.loads(args.child)), ensure_ascii=False))
+        return 0
+
+    import pandas as pd
+    results = []
+    for stores in args.stores:
+        for scenario in args.scenarios:
+            params = {"scenario": scenario, "stores": stores, "staff": args.staff, "workers": args.workers,
+                      "latency_ms": args.latency_ms, "error_rate": args.error_rate, "seed": args.seed, "quota": args.quota}
+            r = run_in_subprocess(params)
+            results.append(r)
+            print(f"  {scenario:<10} {stores:>5} 間門市：{r['wall_s']:.2f}s・API {r['api_calls']} 次・峰值 +{r['peak_mb']:.1f} MB", flush=True)
+
+    table = pd.DataFrame(results)[["scenario", "stores", "wall_s", "api_calls", "sheets_calls", "drive_calls",
+                                   "retries", "p95_call_ms", "peak_mb", "errors"]]
+    print(table.rename(columns={
+        "scenario": "情境", "stores": "門市數", "wall_s": "耗時 (秒)", "api_calls": "API 呼叫", "sheets_calls": "Sheets",
+        "drive_calls": "Drive", "retries": "重試", "p95_call_ms": "單次 p95 (ms)", "peak_mb": "峰值記憶體 (MB)", "errors": "錯誤",
+    }).to_string(index=False))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f: json.dump(results, f, ensure_ascii=False, indent=1)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f: problems = compare(results, json.load(f), args.tolerance)
+        for p in problems: print(f"⚠️ 效能退步：{p}")
+        if problems: return 1
+    return 1 if any(r["errors"] for r in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
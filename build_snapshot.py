@@ -0,0 +1,74 @@
+"""
+排程用的全店快照產生器，不需啟動 Streamlit。
+
+    python build_snapshot.py                  # 掃描本月
+    python build_snapshot.py --month 2025-09  # 指定月份
+    python build_snapshot.py --previous       # 本月與上個月 (月初補齊上月資料)
+    python build_snapshot.py --history        # 同時匯入本機歷史資料庫 (已結帳月份只匯入一次)
+    python build_snapshot.py --trace trace.jsonl  # 將本次的 API 呼叫紀錄寫成 JSON Lines
+
+設定讀自 .streamlit/secrets.toml (與介面相同)，快照寫入 SNAPSHOT_DIR (預設 snapshots/)。
+有門市讀取失敗時仍會寫入快照，但結束代碼為 1，方便排程告警。
+"""
+import argparse
+import sys
+from datetime import date, datetime, timedelta
+
+import toml  # Streamlit 也以 toml 解析 secrets.toml
+
+import kpi_core
+
+def target_months(month=None, previous=False):
+    first = datetime.strptime(month, "%Y-%m").date() if month else date.today().replace(day=1)
+    months = [first]
+    if previous: months.append((first - timedelta(days=1)).replace(day=1))
+    return months
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="掃描全店日報表並寫入版本化快照")
+    parser.add_argument("--month", help="YYYY-MM，預設為本月")
+    parser.add_argument("--previous", action="store_true", help="同時重建上個月")
+    parser.add_argument("--secrets", default=".streamlit/secrets.toml", help="Secrets 檔路徑")
+    parser.add_argument("--out", help="快照目錄，預設為 Secrets 中的 SNAPSHOT_DIR 或 snapshots")
+    parser.add_argument("--workers", type=int, help="並行讀取數，預設為 Secrets 中的 SCAN_MAX_WORKERS 或 8")
+    parser.add_argument("--keep", type=int, default=10, help="每個月份保留的快照版本數")
+    parser.add_argument("--history", action="store_true", help="同時匯入 HISTORY_PATH 歷史資料庫")
+    parser.add_argument("--trace", help="API 呼叫紀錄輸出路徑 (JSON Lines)")
+    args = parser.parse_args(argv)
+
+    settings = toml.load(args.secrets)
+    kpi_core.configure(settings)
+    out = args.out or settings.get("SNAPSHOT_DIR", "snapshots")
+    workers = args.workers or int(settings.get("SCAN_MAX_WORKERS", 8))
+    projection = bool(settings.get("SCAN_COLUMN_PROJECTION", True))
+
+    with kpi_core.trace_action("載入 KPI 設定"): config = kpi_core.load_system_config()
+    print(f"🧩 KPI 設定：{kpi_core.get_config_cache().source}・{len(config)} 項")
+
+    history = kpi_core.KpiHistory(settings.get("HISTORY_PATH", "kpi_history.sqlite3")) if args.history else None
+    status = 0
+    for month in target_months(args.month, args.previous):
+        with kpi_core.trace_action(f"排程快照 {month:%Y%m}"):
+            df, msg, cube = kpi_core.scan_month_stores(
+                month, max_workers=workers, column_projection=projection,
+                progress=lambda done, total, store: print(f"  讀取：{store} ({done}/{total})"),
+            )
+        print(msg)
+        if cube is None:
+            status = 1
+            continue
+        if df.attrs['scan_stats']['errors']: status = 1
+        print(f"📦 已寫入快照：{kpi_core.write_snapshot(out, df, cube, msg, keep=args.keep)}")
+        if history:
+            with kpi_core.trace_action(f"匯入歷史資料 {month:%Y%m}"):
+                ok, history_msg = kpi_core.ingest_month(history, month, workers, projection,
+                                                        grace_days=int(settings.get("HISTORY_GRACE_DAYS", 5)))
+            print(history_msg)
+            if not ok and not history.is_closed(month.strftime('%Y%m')): status = 1
+    if args.trace:
+        with open(args.trace, "w", encoding="utf-8") as f: n = kpi_core.get_api_tracer().write_jsonl(f)
+        print(f"🔬 API 呼叫紀錄 {n} 筆：{args.trace}")
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,368 @@
+"""
+離線用的 Google Sheets / Drive 假後端與合成資料產生器 (基準測試、壓力測試與本機展示用)。
+
+設定值 KPI_BACKEND = "fake" 時，kpi_core.get_gspread_client() 改用這裡的假傳輸層：
+gspread 與 googleapiclient 的請求流程、ApiGuard 限流重試與 API 追蹤都照常執行，
+只有最底層的 HTTP 請求改由記憶體內的資料回應，因此量到的 API 呼叫次數與真實環境相同。
+
+    FAKE_STORES / FAKE_STORE_NAMES   門市數 / 指定門市名稱 (名稱需以「店」結尾，預設為 STORE_NAMES)
+    FAKE_STAFF                       每間門市的人員分頁數
+    FAKE_MONTHS                      產生本月往前幾個月份 (預設 2：本月與上月)
+    FAKE_LATENCY_MS                  每次請求的延遲 (毫秒)
+    FAKE_QUOTA_ERROR_RATE            每次請求回傳 429 配額錯誤的機率
+    FAKE_SEED                        亂數種子
+"""
+import calendar
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+from urllib.parse import parse_qs, unquote, urlparse
+
+import numpy as np
+
+import kpi_core
+from kpi_core import DAY_FIRST_ROW, KPI_FIRST_COL, STORE_NAMES, process_singleton, setting
+
+FOLDER_MIME = "application/vnd.google-apps.folder"
+SHEET_MIME = "application/vnd.google-apps.spreadsheet"
+FAKE_ROOT_ID = "fake-root"
+HEADER_ROW = DAY_FIRST_ROW - 1
+MAX_DAYS = 31
+
+# --- 記憶體內的試算表與檔案 ---
+
+class FakeTab:
+    """單一分頁：數值存在 float64 陣列 (NaN 為空白)，文字另存 {(列, 欄): 字串}；列欄皆為 0 起始。"""
+    def __init__(self, sheet_id, title, rows=HEADER_ROW + MAX_DAYS, cols=KPI_FIRST_COL + 20):
+        self.sheet_id = sheet_id
+        self.title = title
+        self.values = np.full((rows, cols), np.nan)
+        self.text = {}
+
+    def _grow(self, rows, cols):
+        r, c = self.values.shape
+        if rows <= r and cols <= c: return
+        grown = np.full((max(rows, r), max(cols, c)), np.nan)
+        grown[:r, :c] = self.values
+        self.values = grown
+
+    def read(self, r0, r1, c0, c1):
+        """回傳與 Sheets API 相同格式的字串表格：每列去掉尾端空白，並去掉尾端的空白列。"""
+        r1, c1 = min(r1, self.values.shape[0]), min(c1, self.values.shape[1])
+        out = [["" if v != v else (str(int(v)) if v.is_integer() else repr(v)) for v in row]
+               for row in self.values[r0:r1, c0:c1].tolist()]
+        for (r, c), text in self.text.items():
+            if r0 <= r < r1 and c0 <= c < c1: out[r - r0][c - c0] = text
+        for row in out:
+            while row and row[-1] == "": row.pop()
+        while out and not out[-1]: out.pop()
+        return out
+
+    def write(self, r0, c0, rows):
+        self._grow(r0 + len(rows), c0 + max((len(r) for r in rows), default=0))
+        for i, row in enumerate(rows):
+            for j, v in enumerate(row):
+                self.text.pop((r0 + i, c0 + j), None)
+                if v is None or v == "": self.values[r0 + i, c0 + j] = np.nan
+                elif isinstance(v, (int, float)) and not isinstance(v, bool): self.values[r0 + i, c0 + j] = float(v)
+                else:
+                    try: self.values[r0 + i, c0 + j] = float(str(v).replace(",", ""))
+                    except ValueError:
+                        self.values[r0 + i, c0 + j] = np.nan
+                        self.text[(r0 + i, c0 + j)] = str(v)
+
+    def extent(self):
+        return self.values.shape
+
+class FakeWorld:
+    """Drive 檔案清單 + 各試算表的分頁；所有讀寫以同一把鎖保護，寫入後更新檔案的 modifiedTime。"""
+    def __init__(self):
+        self.files = {}    # id -> Drive 檔案資訊
+        self.sheets = {}   # id -> {分頁名稱: FakeTab}
+        self.store_names = []
+        self.lock = threading.RLock()
+        self._ids = 0
+        self._clock = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+    def _new_id(self, prefix):
+        self._ids += 1
+        return f"{prefix}{self._ids:06d}"
+
+    def _tick(self):
+        self._clock = max(self._clock + timedelta(microseconds=1), datetime.now(timezone.utc))
+        return self._clock.isoformat(timespec="microseconds").replace("+00:00", "Z")
+
+    def add_folder(self, name, parent=None, file_id=None):
+        file_id = file_id or self._new_id("fold")
+        self.files[file_id] = {"id": file_id, "name": name, "mimeType": FOLDER_MIME, "parents": [parent] if parent else [],
+                               "modifiedTime": self._tick(), "trashed": False,
+                               "webViewLink": f"https://drive.google.com/drive/folders/{file_id}"}
+        return file_id
+
+    def add_spreadsheet(self, name, parent, tabs):
+        file_id = self._new_id("sheet")
+        self.files[file_id] = {"id": file_id, "name": name, "mimeType": SHEET_MIME, "parents": [parent],
+                               "modifiedTime": self._tick(), "trashed": False,
+                               "webViewLink": f"https://docs.google.com/spreadsheets/d/{file_id}"}
+        self.sheets[file_id] = {tab.title: tab for tab in tabs}
+        return file_id
+
+    def touch(self, file_id):
+        self.files[file_id]["modifiedTime"] = self._tick()
+
+    def find_file(self, name):
+        return next((f for f in self.files.values() if f["name"] == name), None)
+
+    def tab(self, name, title):
+        """依檔名與分頁名稱取得分頁 (驗證寫入結果用)。"""
+        return self.sheets[self.find_file(name)["id"]][title]
+
+# --- 合成資料 ---
+
+def synthetic_store_names(n, names=None):
+    names = list(names or [])[:n]
+    while len(names) < n: names.append(f"測試{len(names) + 1:04d}店")
+    return names
+
+def _random_block(rng, config, n_days, width, fill):
+    """n_days × width 的每日數值：依 KPI 類型產生合理範圍，約 fill 比例的儲存格有值。"""
+    block = np.full((n_days, width), np.nan)
+    for cfg in config.values():
+        if cfg['type'] == 'money': col = rng.integers(0, 20, n_days) * 500.0
+        elif cfg['type'] == 'percent': col = np.round(rng.random(n_days), 2)
+        elif cfg['type'] == 'float': col = np.round(rng.random(n_days) * 100, 1)
+        else: col = rng.integers(0, 6, n_days).astype(float)
+        block[:, cfg['col']] = np.where(rng.random(n_days) < fill, col, np.nan)
+    return block
+
+def _report_tab(sheet_id, title, config, month, block):
+    """與實際日報表相同版面：第 14 列表頭 (A 欄日期、KPI 從 B 欄起)，第 15 列起每日一列。"""
+    width = block.shape[1]
+    tab = FakeTab(sheet_id, title, cols=KPI_FIRST_COL + width)
+    tab.text[(HEADER_ROW - 1, 0)] = "日期"
+    for cfg in config.values(): tab.text[(HEADER_ROW - 1, KPI_FIRST_COL - 1 + cfg['col'])] = cfg['label']
+    for d in range(block.shape[0]): tab.text[(HEADER_ROW + d, 0)] = f"{month.month}/{d + 1}"
+    tab.values[HEADER_ROW:HEADER_ROW + block.shape[0], KPI_FIRST_COL - 1:KPI_FIRST_COL - 1 + width] = block
+    return tab
+
+def generate_world(n_stores=10, n_staff=5, months=None, config=None, seed=0, store_names=None, fill=0.7,
+                   root_id=FAKE_ROOT_ID):
+    """
+    產生 n_stores 間門市 × n_staff 位人員 × 每月每日 × KPI 欄位的假資料與 Drive 資料夾結構：
+    根目錄下有 system_kpi_config 與各月份資料夾 (YYYYMM)，每間門市一份「YYYY_MM_門市業績日報表」，
+    含門市總表分頁 (人員加總，overwrite 欄位取平均) 與各人員分頁。
+    """
+    config = config or kpi_core.DEFAULT_KPI_CONFIG
+    months = months or [date.today().replace(day=1)]
+    width = max(cfg['col'] for cfg in config.values()) + 1
+    overwrite = [cfg['col'] for cfg in config.values() if cfg.get('mode') == 'overwrite']
+    rng = np.random.default_rng(seed)
+    world = FakeWorld()
+    root = world.add_folder("KPI", file_id=root_id)
+
+    config_tab = FakeTab(0, "Config", rows=len(config) + 1, cols=6)
+    config_tab.write(0, 0, [["名稱", "Excel欄位(0起始)", "類型", "分類", "顯示標籤", "模式"]] +
+                     [[k, v['col'], v['type'], v['cat'], v['label'], v.get('mode', '')] for k, v in config.items()])
+    world.add_spreadsheet("system_kpi_config", root, [config_tab])
+
+    names = world.store_names = synthetic_store_names(n_stores, store_names)
+    staff_names = [f"人員{j + 1:02d}" for j in range(n_staff)]
+    for month in months:
+        folder = world.add_folder(month.strftime("%Y%m"), root)
+        n_days = calendar.monthrange(month.year, month.month)[1]
+        for store in names:
+            blocks = [_random_block(rng, config, n_days, width, fill) for _ in staff_names]
+            total = np.nansum(blocks, axis=0) if blocks else np.full((n_days, width), np.nan)
+            if blocks and overwrite:
+                stacked = np.stack(blocks)[:, :, overwrite]
+                filled = (~np.isnan(stacked)).sum(axis=0)
+                total[:, overwrite] = np.where(filled > 0, np.round(np.nansum(stacked, axis=0) / np.maximum(filled, 1), 2), np.nan)
+            tabs = [_report_tab(0, store, config, month, total)]
+            tabs += [_report_tab(i + 1, name, config, month, block) for i, (name, block) in enumerate(zip(staff_names, blocks))]
+            world.add_spreadsheet(f"{month:%Y_%m}_{store}業績日報表", folder, tabs)
+    return world
+
+# --- 假傳輸層 ---
+
+def _error_body(code, message, status):
+    return {"error": {"code": code, "message": message, "status": status}}
+
+class FakeBackend:
+    """
+    假後端：world 的資料 + 每次請求的延遲與配額錯誤。
+    sheets_session() 給 gspread 的 HTTPClient 使用，drive_service() 是以假 http 建立的 googleapiclient Drive 服務。
+    """
+    service_account_email = "fake-backend@kpi.local"
+
+    def __init__(self, world, latency_ms=0.0, quota_error_rate=0.0, seed=0):
+        self.world = world
+        self.latency = latency_ms / 1000.0
+        self.quota_error_rate = quota_error_rate
+        self.calls = Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def before_call(self, api):
+        """模擬網路延遲；依機率回傳配額錯誤 (None 表示正常處理)。"""
+        with self._lock:
+            self.calls[api] += 1
+            fail = self.quota_error_rate and self._rng.random() < self.quota_error_rate
+            if fail: self.calls["quota_errors"] += 1
+        if self.latency: time.sleep(self.latency)
+        if fail: return 429, _error_body(429, f"Quota exceeded for {api} (rateLimitExceeded)", "RESOURCE_EXHAUSTED")
+        return None
+
+    def stats(self):
+        with self._lock: return dict(self.calls)
+
+    def sheets_session(self):
+        return FakeSheetsSession(self)
+
+    def drive_service(self):
+        from googleapiclient.discovery import build
+        return build("drive", "v3", http=FakeDriveHttp(self), static_discovery=True, cache_discovery=False)
+
+_SHEETS_PATH = re.compile(r"^/v4/spreadsheets/([^/:]+)(.*)$")
+_QUOTED_TITLE = re.compile(r"^'((?:[^']|'')*)'(?:!(.*))?$")
+
+def _split_range(tabs, range_name):
+    """'分頁'!A1:B2 / 分頁!A1 / '分頁' / A1:B2 → (FakeTab, 列起, 列迄, 欄起, 欄迄)，迄為不含。"""
+    from gspread.utils import a1_range_to_grid_range
+    m = _QUOTED_TITLE.match(range_name)
+    if m: title, a1 = m.group(1).replace("''", "'"), m.group(2)
+    elif "!" in range_name: title, a1 = range_name.split("!", 1)
+    elif range_name in tabs: title, a1 = range_name, None
+    else: title, a1 = next(iter(tabs)), range_name
+    tab = tabs.get(title)
+    if tab is None: raise KeyError(range_name)
+    rows, cols = tab.extent()
+    if not a1: return tab, 0, rows, 0, cols
+    grid = a1_range_to_grid_range(a1)
+    return (tab, grid.get("startRowIndex", 0), grid.get("endRowIndex", rows),
+            grid.get("startColumnIndex", 0), grid.get("endColumnIndex", cols))
+
+class FakeSheetsSession:
+    """代替 requests.Session：依 Sheets API v4 的 URL 回應 metadata、values.get/batchGet/update/batchUpdate。"""
+    def __init__(self, backend):
+        self.backend = backend
+        self.world = backend.world
+
+    def request(self, method, url, params=None, json=None, data=None, files=None, headers=None, timeout=None):
+        import requests
+        error = self.backend.before_call("sheets")
+        status, body = error or self._dispatch(method.upper(), url, params or {}, json)
+        response = requests.Response()
+        response.status_code = status
+        response._content = _dumps(body)
+        response.headers["Content-Type"] = "application/json; charset=UTF-8"
+        response.url = url
+        response.request = requests.Request(method.upper(), url, json=json).prepare()
+        return response
+
+    def _dispatch(self, method, url, params, body):
+        m = _SHEETS_PATH.match(unquote(urlparse(url).path))
+        if not m: return 404, _error_body(404, f"Unsupported URL: {url}", "NOT_FOUND")
+        file_id, rest = m.groups()
+        with self.world.lock:
+            tabs = self.world.sheets.get(file_id)
+            if tabs is None: return 404, _error_body(404, "Requested entity was not found.", "NOT_FOUND")
+            try:
+                if rest == "" and method == "GET": return 200, self._metadata(file_id, tabs)
+                if rest == "/values:batchGet" and method == "GET":
+                    ranges = params.get("ranges", [])
+                    ranges = [ranges] if isinstance(ranges, str) else ranges
+                    return 200, {"spreadsheetId": file_id, "valueRanges": [self._get(tabs, r) for r in ranges]}
+                if rest.startswith("/values/") and method == "GET": return 200, self._get(tabs, rest[len("/values/"):])
+                if rest.startswith("/values/") and method == "PUT":
+                    return 200, self._update(file_id, tabs, [{"range": rest[len("/values/"):], "values": (body or {}).get("values", [])}])
+                if rest == "/values:batchUpdate" and method == "POST": return 200, self._update(file_id, tabs, (body or {}).get("data", []))
+            except KeyError as e:
+                return 400, _error_body(400, f"Unable to parse range: {e.args[0]}", "INVALID_ARGUMENT")
+        return 400, _error_body(400, f"Unsupported request: {method} {rest}", "INVALID_ARGUMENT")
+
+    def _metadata(self, file_id, tabs):
+        return {
+            "spreadsheetId": file_id,
+            "properties": {"title": self.world.files[file_id]["name"], "locale": "zh_TW", "timeZone": "Asia/Taipei"},
+            "sheets": [{"properties": {"sheetId": tab.sheet_id, "title": tab.title, "index": i, "sheetType": "GRID",
+                                       "gridProperties": dict(zip(("rowCount", "columnCount"), tab.extent()))}}
+                       for i, tab in enumerate(tabs.values())],
+        }
+
+    def _get(self, tabs, range_name):
+        tab, r0, r1, c0, c1 = _split_range(tabs, range_name)
+        result = {"range": range_name, "majorDimension": "ROWS"}
+        values = tab.read(r0, r1, c0, c1)
+        if values: result["values"] = values
+        return result
+
+    def _update(self, file_id, tabs, data):
+        cells = 0
+        for item in data:
+            tab, r0, _, c0, _ = _split_range(tabs, item["range"])
+            tab.write(r0, c0, item.get("values", []))
+            cells += sum(len(r) for r in item.get("values", []))
+        if data: self.world.touch(file_id)
+        return {"spreadsheetId": file_id, "totalUpdatedCells": cells, "totalUpdatedSheets": len(data)}
+
+class FakeDriveHttp:
+    """代替 httplib2.Http：回應 Drive v3 的 files.list (q 支援 in parents / name / mimeType / trashed) 與 files.get。"""
+    _CLAUSE = re.compile(r"^(?:'(?P<parent>[^']*)' in parents|(?P<field>name|mimeType) = '(?P<value>(?:[^'\\]|\\.)*)'|trashed = (?P<trashed>true|false))$")
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.world = backend.world
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=5, connection_type=None):
+        import httplib2
+        status, payload = self.backend.before_call("drive") or self._dispatch(method.upper(), uri)
+        return httplib2.Response({"status": status, "content-type": "application/json; charset=UTF-8"}), _dumps(payload)
+
+    def _dispatch(self, method, uri):
+        parsed = urlparse(uri)
+        path, query = parsed.path, parse_qs(parsed.query)
+        if method != "GET": return 400, _error_body(400, f"Unsupported request: {method} {path}", "invalidArgument")
+        with self.world.lock:
+            if path.rstrip("/").endswith("/drive/v3/files"): return self._list(query)
+            file_id = unquote(path.rsplit("/", 1)[-1])
+            f = self.world.files.get(file_id)
+            if f is None: return 404, _error_body(404, f"File not found: {file_id}.", "notFound")
+            return 200, dict(f)
+
+    def _list(self, query):
+        tests = []
+        for clause in filter(None, (c.strip() for c in query.get("q", [""])[0].split(" and "))):
+            m = self._CLAUSE.match(clause)
+            if not m: return 400, _error_body(400, f"Invalid Value: {clause}", "invalid")
+            if m.group("parent") is not None: tests.append(lambda f, p=m.group("parent"): p in f["parents"])
+            elif m.group("field"): tests.append(lambda f, k=m.group("field"), v=m.group("value").replace("\\'", "'"): f[k] == v)
+            else: tests.append(lambda f, t=m.group("trashed") == "true": f["trashed"] == t)
+        matched = [dict(f) for f in self.world.files.values() if all(t(f) for t in tests)]
+        page_size = min(int(query.get("pageSize", ["100"])[0]), 1000)
+        start = int(query.get("pageToken", ["0"])[0] or 0)
+        result = {"files": matched[start:start + page_size]}
+        if start + page_size < len(matched): result["nextPageToken"] = str(start + page_size)
+        return 200, result
+
+def _dumps(payload):
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+@process_singleton
+def get_fake_backend():
+    """依設定值建立的全程序共用假後端 (KPI_BACKEND = "fake" 時由 get_gspread_client 使用)。"""
+    first = date.today().replace(day=1)
+    months = [first]
+    for _ in range(int(setting("FAKE_MONTHS", 2)) - 1): months.append((months[-1] - timedelta(days=1)).replace(day=1))
+    # 未指定名稱時沿用介面的門市清單 (略過第一項的全店總表)
+    store_names = setting("FAKE_STORE_NAMES") or STORE_NAMES[1:]
+    world = generate_world(
+        n_stores=int(setting("FAKE_STORES", len(store_names))),
+        n_staff=int(setting("FAKE_STAFF", 5)), months=months, seed=int(setting("FAKE_SEED", 0)),
+        store_names=store_names, root_id=setting("TARGET_FOLDER_ID") or FAKE_ROOT_ID,
+    )
+    return FakeBackend(world, float(setting("FAKE_LATENCY_MS", 0)), float(setting("FAKE_QUOTA_ERROR_RATE", 0)),
+                       int(setting("FAKE_SEED", 0)))
@@ -0,0 +1,1887 @@
+"""
+門市業績日報表的讀取與彙整核心，不依賴 Streamlit。
+介面 (app.py) 與排程用的 build_snapshot.py 共用同一套 API 限流、Drive 索引、KPI 設定與全店掃描。
+設定值 (Secrets) 由 configure() 傳入：介面傳 st.secrets，CLI 傳 secrets.toml 的內容。
+"""
+import calendar
+import contextlib
+import contextvars
+import csv
+import functools
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+# --- 設定來源與程序內共用物件 ---
+
+SETTINGS = {}
+
+def configure(settings):
+    """
+    設定 Secrets 來源；需在第一次建立連線前呼叫。
+    以一次指派整組替換，背景執行緒與其他 session 同時呼叫 setting() 不會讀到清空到一半的設定。
+    """
+    global SETTINGS
+    SETTINGS = dict(settings)
+
+def setting(key, default=None):
+    return SETTINGS.get(key, default)
+
+_SINGLETON_LOCK = threading.RLock()
+
+def process_singleton(factory):
+    """
+    程序內只建立一次的共用物件，作用同 st.cache_resource (Streamlit rerun 不會重新匯入模組)。
+    建立時拋出例外則不快取，下次呼叫重試。
+    """
+    instance = []
+
+    @functools.wraps(factory)
+    def get():
+        if not instance:
+            with _SINGLETON_LOCK:
+                if not instance: instance.append(factory())
+        return instance[0]
+    return get
+
+# ==============================================================================
+# ⚙️ 預設設定 (Fallback) - 當雲端設定檔讀取失敗時使用
+# ==============================================================================
+DEFAULT_KPI_CONFIG = {
+    "毛利":       {"col": 0,  "type": "money",  "cat": "finance", "label": "毛利 ($)"},
+    "門號":       {"col": 1,  "type": "int",    "cat": "finance", "label": "門號 (件)"},
+    "保險營收":   {"col": 2,  "type": "money",  "cat": "finance", "label": "保險營收 ($)"},
+    "配件營收":   {"col": 3,  "type": "money",  "cat": "finance", "label": "配件營收 ($)"},
+    "庫存手機":   {"col": 4,  "type": "int",    "cat": "hardware", "label": "庫存手機 (台)"},
+    "蘋果手機":   {"col": 5,  "type": "int",    "cat": "hardware", "label": "蘋果手機 (台)"},
+    "蘋果平板+手錶": {"col": 6, "type": "int",  "cat": "hardware", "label": "蘋果平板/手錶 (台)"},
+    "華為穿戴":     {"col": 7,  "type": "int",    "cat": "target",   "label": "華為穿戴 (台)"},
+    "橙艾玻璃貼":   {"col": 8,  "type": "int",    "cat": "target",   "label": "橙艾玻璃貼 (張)"},
+    "VIVO銷售目標": {"col": 9,  "type": "int",    "cat": "target",   "label": "VIVO銷售目標 (台)"},
+    "GPLUS吸塵器":  {"col": 10, "type": "int",    "cat": "target",   "label": "GPLUS吸塵器 (台)"},
+    "生活圈":       {"col": 11, "type": "int",    "cat": "service",  "label": "生活圈 (人)"},
+    "GOOGLE 評論":  {"col": 12, "type": "int",    "cat": "service",  "label": "Google 評論 (則)"},
+    "來客數":       {"col": 13, "type": "int",    "cat": "service",  "label": "來客數 (人)"},
+    "遠傳續約":        {"col": 14, "type": "int",    "cat": "project",  "label": "遠傳續約 (件)"},
+    "遠傳續約累積GAP": {"col": 15, "type": "int",    "cat": "project",  "label": "續約累積 GAP"},
+    "遠傳升續率":      {"col": 16, "type": "percent","cat": "project",  "label": "升續率 (%)", "mode": "overwrite"},
+    "遠傳平續率":      {"col": 17, "type": "percent","cat": "project",  "label": "平續率 (%)", "mode": "overwrite"},
+    "綜合指標":        {"col": 18, "type": "float",  "cat": "score",    "label": "綜合指標分數", "mode": "overwrite"}
+}
+
+# API 可重試錯誤的重試次數與退避秒數
+API_MAX_RETRIES = 5
+API_BACKOFF_BASE = 1.0
+API_BACKOFF_MAX = 32.0
+
+# --- 組織定義 ---
+STORE_NAMES = [
+    "(ALL) 全店總表",
+    "文賢店", "東門店", "永康店", "歸仁店", "安中店",
+    "小西門店", "鹽行店", "五甲店", "鳳山店"
+]
+
+# --- Google Sheets 連線與工具 ---
+
+class TokenBucket:
+    """每分鐘 rate 次的權杖桶；權杖不足時 acquire 會阻塞到可用為止，回傳等待秒數。"""
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0: time.sleep(wait)
+        return wait
+
+def _error_status(err):
+    """取出 gspread APIError / googleapiclient HttpError 的 HTTP 狀態碼。"""
+    code = getattr(err, 'code', None)
+    if code is None and getattr(err, 'resp', None) is not None:
+        code = getattr(err.resp, 'status', None)
+    try: return int(code)
+    except (TypeError, ValueError): return None
+
+def is_retryable_error(err):
+    code = _error_status(err)
+    if code is None: return isinstance(err, (OSError, TimeoutError))
+    if code == 403: return any(r in str(err) for r in ("rateLimitExceeded", "userRateLimitExceeded", "usageLimits"))
+    return code in (408, 429) or code >= 500
+
+class ApiGuard:
+    """
+    全程序共用的 API 限流與重試層。
+    Sheets 與 Drive 各有一個權杖桶；可重試錯誤 (429/408/5xx/配額 403/網路錯誤) 以指數退避 + 抖動重試。
+    """
+    def __init__(self, sheets_per_minute, drive_per_minute, max_retries=API_MAX_RETRIES):
+        self.buckets = {"sheets": TokenBucket(sheets_per_minute), "drive": TokenBucket(drive_per_minute)}
+        self.max_retries = max_retries
+        self.counters = {"calls": 0, "throttled": 0, "retried": 0, "failed": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock: self.counters[name] += 1
+
+    def call(self, api, fn, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            if self.buckets[api].acquire() > 0: self._count("throttled")
+            self._count("calls")
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable_error(e):
+                    self._count("failed")
+                    raise
+                self._count("retried")
+                time.sleep(min(API_BACKOFF_BASE * 2 ** attempt, API_BACKOFF_MAX) * random.uniform(0.5, 1.5))
+
+    def stats(self):
+        with self._lock: return dict(self.counters)
+
+@process_singleton
+def get_api_guard():
+    return ApiGuard(int(setting("SHEETS_QUOTA_PER_MINUTE", 60)), int(setting("DRIVE_QUOTA_PER_MINUTE", 600)))
+
+# --- API 呼叫追蹤 ---
+
+_TRACE_ACTION = contextvars.ContextVar("kpi_trace_action", default=None)
+UNTRACED_ACTION = "(未標記)"
+TRACE_FIELDS = ["ts", "action", "action_id", "api", "op", "target", "latency_ms", "attempts",
+                "request_bytes", "response_bytes", "outcome", "error", "thread"]
+
+class ApiTracer:
+    """
+    全程序共用的 API 呼叫紀錄，只保留最近 max_events 筆 (0 為停用)。
+    每筆記下操作、目標檔案、耗時 (含限流等待與重試)、傳輸量與結果，以及觸發它的使用者動作。
+    動作以 contextvars 標記，執行緒池工作以 submit_in_context 提交即沿用提交時的動作。
+    """
+    def __init__(self, max_events):
+        self.max_events = max_events
+        self._events = deque(maxlen=max(max_events, 1))
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def action(self, name):
+        """區塊內的 API 呼叫歸屬於動作 name；巢狀使用時沿用最外層 (實際由使用者觸發的) 動作。"""
+        if _TRACE_ACTION.get() is not None:
+            yield
+            return
+        token = _TRACE_ACTION.set((name, next(self._ids)))
+        try: yield
+        finally: _TRACE_ACTION.reset(token)
+
+    def record(self, api, op, target, started, latency, attempts, error=None, request_bytes=0, response_bytes=0):
+        if not self.max_events: return
+        action, action_id = _TRACE_ACTION.get() or (UNTRACED_ACTION, 0)
+        event = {
+            "ts": round(started, 3), "action": action, "action_id": action_id, "api": api, "op": op, "target": target,
+            "latency_ms": round(latency * 1000, 1), "attempts": attempts,
+            "request_bytes": request_bytes, "response_bytes": response_bytes,
+            "outcome": "ok" if error is None else str(_error_status(error) or type(error).__name__),
+            "error": None if error is None else str(error)[:200], "thread": threading.current_thread().name,
+        }
+        with self._lock: self._events.append(event)
+
+    def events(self):
+        with self._lock: return list(self._events)
+
+    def frame(self):
+        return pd.DataFrame(self.events(), columns=TRACE_FIELDS)
+
+    def clear(self):
+        with self._lock: self._events.clear()
+
+    def write_jsonl(self, fileobj):
+        """每筆一行 JSON 寫入文字檔物件，回傳筆數。"""
+        events = self.events()
+        for event in events: fileobj.write(json.dumps(event, ensure_ascii=False) + "\n")
+        return len(events)
+
+def summarize_trace(df, by="action"):
+    """依 by (動作或操作) 彙整：觸發次數、呼叫數、錯誤、重試、單次呼叫 p50/p95 耗時、合計耗時與傳輸量。"""
+    columns = ["觸發次數", "呼叫數", "錯誤", "重試", "p50 (ms)", "p95 (ms)", "合計 (秒)", "傳輸 (KB)"]
+    if df.empty: return pd.DataFrame(columns=columns)
+    g = df.assign(
+        failed=df["outcome"] != "ok", retries=df["attempts"] - 1, nbytes=df["request_bytes"] + df["response_bytes"],
+    ).groupby(by, sort=False)
+    out = pd.DataFrame({
+        "觸發次數": g["action_id"].nunique(), "呼叫數": g.size(), "錯誤": g["failed"].sum(), "重試": g["retries"].sum(),
+        "p50 (ms)": g["latency_ms"].quantile(0.5), "p95 (ms)": g["latency_ms"].quantile(0.95),
+        "合計 (秒)": g["latency_ms"].sum() / 1000, "傳輸 (KB)": g["nbytes"].sum() / 1024,
+    })
+    return out.round(2).sort_values("合計 (秒)", ascending=False)
+
+@process_singleton
+def get_api_tracer():
+    return ApiTracer(int(setting("API_TRACE_MAX_EVENTS", 20000)))
+
+def trace_action(name):
+    return get_api_tracer().action(name)
+
+def submit_in_context(pool, fn, *args, **kwargs):
+    """以提交當下的 contextvars (追蹤動作) 在執行緒池中執行 fn。"""
+    return pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+def traced_call(api, op, target, fn, payload_sizes=None):
+    """
+    經 ApiGuard 執行 fn 並寫入追蹤紀錄；耗時包含限流等待與重試。
+    payload_sizes(結果, 例外) 回傳 (送出位元組, 回應位元組)。
+    """
+    attempts = [0]
+    def attempt():
+        attempts[0] += 1
+        return fn()
+    started, t0 = time.time(), time.perf_counter()
+    result = error = None
+    try:
+        result = get_api_guard().call(api, attempt)
+        return result
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        sizes = payload_sizes(result, error) if payload_sizes else (0, 0)
+        get_api_tracer().record(api, op, target, started, time.perf_counter() - t0, attempts[0], error, *sizes)
+
+_SHEETS_URL = re.compile(r"/spreadsheets/([^/:?]+)([^?]*)")
+_DRIVE_FILE_URL = re.compile(r"/files/([^/?]+)")
+_DRIVE_PARENT_QUERY = re.compile(r"'([^']+)' in parents")
+
+def sheets_operation(method, url):
+    """由 gspread 請求的 URL 判斷操作名稱與試算表 ID (範圍已 URL 編碼，路徑中的冒號只會是動作後綴)。"""
+    m = _SHEETS_URL.search(url)
+    if not m: return f"{method.lower()} {url.split('?')[0].rsplit('/', 1)[-1]}", ""
+    file_id, rest = m.groups()
+    if rest.startswith("/values/"):
+        verb = rest.rsplit(":", 1)[1] if ":" in rest else ("update" if method.lower() == "put" else "get")
+        return f"values.{verb}", file_id
+    if rest.startswith("/values:"): return f"values.{rest[8:]}", file_id
+    if rest.startswith(":"): return f"spreadsheets.{rest[1:]}", file_id
+    return "spreadsheets.get" if not rest else f"spreadsheets{rest.replace('/', '.')}", file_id
+
+def _sheets_payload_sizes(response, error):
+    response = response if error is None else getattr(error, "response", None)
+    request_body = getattr(getattr(response, "request", None), "body", None) or b""
+    return len(request_body), len(getattr(response, "content", b"") or b"")
+
+def drive_operation(request):
+    """Drive 請求的操作名稱 (methodId) 與目標：檔案 ID，列表時為上層資料夾 ID。"""
+    op = getattr(request, "methodId", None) or "drive"
+    uri = getattr(request, "uri", "") or ""
+    m = _DRIVE_FILE_URL.search(uri.split("?")[0])
+    if m: return op, m.group(1)
+    from urllib.parse import parse_qs, urlparse
+    q = parse_qs(urlparse(uri).query).get("q", [""])[0]
+    m = _DRIVE_PARENT_QUERY.search(q)
+    return op, m.group(1) if m else ""
+
+def _drive_payload_sizes(result, error):
+    # Drive 回應已解析成 dict，以重新序列化的長度近似回應大小
+    return 0, len(json.dumps(result, ensure_ascii=False).encode()) if result is not None else 0
+
+# httplib2 不是執行緒安全的：掃描、背景預載與上傳佇列的 Drive 請求各自使用所在執行緒的 http 物件
+_DRIVE_HTTP = threading.local()
+_drive_http_factory = None
+
+def thread_drive_http():
+    """目前執行緒專用的已授權 http 物件 (get_gspread_client 建立連線後才有；假後端為 None)。"""
+    if _drive_http_factory is None: return None
+    http = getattr(_DRIVE_HTTP, "http", None)
+    if http is None: http = _DRIVE_HTTP.http = _drive_http_factory()
+    return http
+
+def drive_execute(request):
+    """執行 Drive API 請求 (經過 ApiGuard 限流與重試，並寫入追蹤紀錄)。"""
+    op, target = drive_operation(request)
+    http = thread_drive_http()
+    execute = functools.partial(request.execute, http=http) if http else request.execute
+    return traced_call("drive", op, target, execute, _drive_payload_sizes)
+
+@process_singleton
+def get_gspread_client():
+    import gspread
+
+    class GuardedHTTPClient(gspread.http_client.HTTPClient):
+        """所有 gspread 請求都經過 ApiGuard 限流與重試，並寫入追蹤紀錄。"""
+        def request(self, method, endpoint, *args, **kwargs):
+            op, target = sheets_operation(method, endpoint)
+            send = functools.partial(super().request, method, endpoint, *args, **kwargs)
+            return traced_call("sheets", op, target, send, _sheets_payload_sizes)
+
+    if setting("KPI_BACKEND", "google") == "fake":
+        # 離線假後端：只換掉最底層的 HTTP 傳輸，限流、重試與追蹤照常執行
+        import fake_backend
+        backend = fake_backend.get_fake_backend()
+        client = gspread.Client(None, session=backend.sheets_session(), http_client=GuardedHTTPClient)
+        return client, backend.drive_service(), backend.service_account_email
+
+    import google_auth_httplib2
+    from google.oauth2.service_account import Credentials
+    from googleapiclient.discovery import build
+    from googleapiclient.http import build_http
+    global _drive_http_factory
+
+    scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
+    creds_dict = dict(setting("gcp_service_account"))
+    creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
+    client = gspread.authorize(creds, http_client=GuardedHTTPClient)
+    drive_service = build('drive', 'v3', credentials=creds)
+    _drive_http_factory = lambda: google_auth_httplib2.AuthorizedHttp(creds, http=build_http())
+    return client, drive_service, creds.service_account_email
+
+def check_connection_status():
+    try:
+        _, _, email = get_gspread_client()
+        return True, email
+    except: return False, None
+
+class DriveIndex:
+    """
+    全程序共用的 Drive 檔案索引。
+    每個資料夾只做一次 (分頁) 列表並記下 檔名 → [id, mimeType, webViewLink, modifiedTime]，
+    之後的檔名查詢直接查表，直到 TTL 過期或手動清除。
+    查不到的檔名會重新列表一次 (列表已超過 miss_ttl 秒時)，剛建立的檔案或月份資料夾不必等 TTL 過期。
+    列表在鎖外進行，同一資料夾同時只有一個列表請求，其他呼叫端等待並共用結果；其他資料夾的查詢不受影響。
+    """
+    FIELDS = "nextPageToken, files(id, name, mimeType, webViewLink, modifiedTime)"
+
+    def __init__(self, ttl, miss_ttl=15):
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.hits = 0
+        self.misses = 0
+        self._folders = {}  # folder_id -> (fetched_at, {name: [file, ...]})
+        self._inflight = {}  # folder_id -> Future
+        self._generation = 0  # invalidate() 後，進行中的列表結果不再寫入索引
+        self._lock = threading.Lock()
+
+    def _fetch_folder(self, drive_service, folder_id):
+        by_name, page_token = {}, None
+        while True:
+            results = drive_execute(drive_service.files().list(
+                q=f"'{folder_id}' in parents and trashed = false",
+                fields=self.FIELDS, pageSize=1000, pageToken=page_token,
+            ))
+            for f in results.get('files', []):
+                by_name.setdefault(f['name'], []).append(f)
+            page_token = results.get('nextPageToken')
+            if not page_token: return by_name
+
+    def list_folder(self, drive_service, folder_id, max_age=None):
+        """回傳 {檔名: [檔案資訊, ...]}；索引未超過 max_age (預設 TTL) 秒時不呼叫 API。"""
+        max_age = self.ttl if max_age is None else min(max_age, self.ttl)
+        with self._lock:
+            entry = self._folders.get(folder_id)
+            if entry and time.time() - entry[0] < max_age:
+                self.hits += 1
+                return entry[1]
+            flight = self._inflight.get(folder_id)
+            owner = flight is None
+            if owner:
+                flight = self._inflight[folder_id] = Future()
+                generation = self._generation
+                self.misses += 1
+        if not owner: return flight.result()
+
+        try:
+            by_name = self._fetch_folder(drive_service, folder_id)
+        except Exception as e:
+            with self._lock: self._inflight.pop(folder_id, None)
+            flight.set_exception(e)
+            raise
+        with self._lock:
+            if generation == self._generation: self._folders[folder_id] = (time.time(), by_name)
+            self._inflight.pop(folder_id, None)
+        flight.set_result(by_name)
+        return by_name
+
+    def find(self, drive_service, folder_id, filename):
+        found = self.list_folder(drive_service, folder_id).get(filename)
+        if found is None: found = self.list_folder(drive_service, folder_id, self.miss_ttl).get(filename)
+        return list(found or [])
+
+    def invalidate(self, folder_id=None):
+        with self._lock:
+            self._generation += 1
+            if folder_id is None: self._folders.clear()
+            else: self._folders.pop(folder_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "folders": len(self._folders),
+                "files": sum(len(v[1]) for v in self._folders.values()),
+                "hits": self.hits, "misses": self.misses, "ttl": self.ttl, "miss_ttl": self.miss_ttl,
+            }
+
+@process_singleton
+def get_drive_index():
+    return DriveIndex(int(setting("DRIVE_INDEX_TTL", 300)), int(setting("DRIVE_INDEX_MISS_TTL", 15)))
+
+# --- 核心：動態載入設定檔 (v17.0 Feature) ---
+
+KPI_TYPES = ("money", "int", "percent", "float")
+KPI_CATEGORIES = ("finance", "hardware", "target", "service", "project", "score")
+
+class KpiLayout:
+    """由 KPI 設定預先計算的查詢結構：分類群組、欄位索引陣列、overwrite 遮罩與設定簽章。"""
+    def __init__(self, config):
+        self.config = config
+        self.keys = list(config)
+        self.cols = np.array([config[k]['col'] for k in self.keys], dtype=np.intp)
+        self.overwrite = np.array([config[k].get('mode') == 'overwrite' for k in self.keys], dtype=bool)
+        self.max_col = int(self.cols.max()) if len(self.keys) else 0
+        self.groups = {}
+        for k in self.keys: self.groups.setdefault(config[k]['cat'], []).append(k)
+        self.signature = tuple((k, config[k]['col'], config[k].get('mode') or '') for k in self.keys)
+
+    def by_cat(self, *cats):
+        return [k for k in self.keys if self.config[k]['cat'] in cats]
+
+def validate_kpi_config(rows):
+    """
+    驗證雲端設定檔的每一列，回傳 (設定, 警告訊息清單)。
+    欄位索引無效的列會被略過；類型/模式不認得時改用預設值並記錄警告。
+    """
+    config, warnings, used_cols = {}, [], {}
+    for i, row in enumerate(rows, start=2):
+        key = str(row.get('名稱', '')).strip()
+        if not key: continue
+        try:
+            col = int(row.get('Excel欄位(0起始)', 0))
+            if col < 0: raise ValueError
+        except (TypeError, ValueError):
+            warnings.append(f"第 {i} 列「{key}」欄位索引無效，已略過")
+            continue
+        kpi_type = str(row.get('類型', 'int')).strip() or 'int'
+        if kpi_type not in KPI_TYPES:
+            warnings.append(f"第 {i} 列「{key}」類型 {kpi_type} 不支援，改用 int")
+            kpi_type = 'int'
+        cat = str(row.get('分類', 'finance')).strip() or 'finance'
+        if cat not in KPI_CATEGORIES: warnings.append(f"第 {i} 列「{key}」分類 {cat} 不在表單分類中，將不會顯示於填報表單")
+        mode = str(row.get('模式', '')).strip()
+        if mode not in ('', 'overwrite'):
+            warnings.append(f"第 {i} 列「{key}」模式 {mode} 不支援，改為累加")
+            mode = ''
+        if key in config: warnings.append(f"第 {i} 列「{key}」名稱重複，以後者為準")
+        if col in used_cols and used_cols[col] != key: warnings.append(f"第 {i} 列「{key}」與「{used_cols[col]}」使用相同欄位 {col}")
+        used_cols[col] = key
+        config[key] = {
+            "col": col,
+            "type": kpi_type,
+            "cat": cat,
+            "label": str(row.get('顯示標籤', key)).strip() or key,
+            "mode": mode,
+        }
+    return config, warnings
+
+class ConfigCache:
+    """
+    全程序共用的 KPI 設定快取。
+    current 為 (設定, KpiLayout) 的不可變組合，整組替換以免不同 session 讀到不一致的版本。
+    """
+    def __init__(self):
+        self.current = None
+        self.source = None
+        self.file_id = None
+        self.modified_time = None
+        self.checked_at = 0.0
+        self.load_seconds = 0.0
+        self.warnings = []
+        self.lock = threading.Lock()
+
+    def set(self, config, source, file_id=None, modified_time=None, warnings=()):
+        self.current = (config, KpiLayout(config))
+        self.source, self.file_id, self.modified_time = source, file_id, modified_time
+        self.warnings = list(warnings)
+        self.checked_at = time.time()
+
+    def invalidate(self):
+        with self.lock:
+            self.checked_at = 0.0
+            self.modified_time = None
+
+@process_singleton
+def get_config_cache():
+    return ConfigCache()
+
+def load_system_config():
+    """
+    嘗試從 Google Drive 讀取 'system_kpi_config' 試算表 (全程序共用快取)。
+    每 CONFIG_REVALIDATE_SECONDS (設定值，預設 60) 秒以設定檔的 modifiedTime 檢查一次，有變更才重新讀取；
+    若失敗則沿用現有設定，從未成功載入過則回傳預設設定。
+    檢查期間其他呼叫端直接沿用現有設定，不等待 API；只有第一次載入時會等待。
+    """
+    cache = get_config_cache()
+    ttl = int(setting("CONFIG_REVALIDATE_SECONDS", 60))
+    current = cache.current
+    if current and time.time() - cache.checked_at < ttl: return current[0]
+    if not cache.lock.acquire(blocking=current is None): return current[0]
+    try:
+        if cache.current and time.time() - cache.checked_at < ttl: return cache.current[0]
+        _revalidate_config(cache)
+        return cache.current[0]
+    finally:
+        cache.lock.release()
+
+def _revalidate_config(cache):
+    """持有 cache.lock 時呼叫：檢查設定檔是否變更，必要時重新讀取並更新快取。"""
+    t0 = time.perf_counter()
+    folder_id = setting("TARGET_FOLDER_ID")
+    try:
+        client, drive_service, _ = get_gspread_client()
+        # 便宜的檢查：只取設定檔的 modifiedTime，沒變就延長有效期
+        if cache.current and cache.file_id and cache.modified_time:
+            meta = drive_execute(drive_service.files().get(fileId=cache.file_id, fields="modifiedTime, trashed"))
+            if not meta.get('trashed') and meta.get('modifiedTime') == cache.modified_time:
+                cache.checked_at = time.time()
+                return
+            get_drive_index().invalidate(folder_id)
+
+        # 搜尋設定檔 (透過 Drive 索引)
+        files = get_drive_index().find(drive_service, folder_id, 'system_kpi_config')
+        if files:
+            sh = client.open_by_key(files[0]['id'])
+            ws = sh.worksheet("Config")
+            data = ws.get_all_records() # 預設第一列為標題
+            new_config, warnings = validate_kpi_config(data)
+            for w in warnings: print(f"⚠️ 設定檔：{w}")
+            if new_config:
+                cache.set(new_config, "cloud", files[0]['id'], files[0].get('modifiedTime'), warnings)
+            else:
+                cache.set(DEFAULT_KPI_CONFIG, "default", warnings=warnings + ["設定檔沒有有效的 KPI，使用預設設定"])
+        else:
+            cache.set(DEFAULT_KPI_CONFIG, "default")
+    except Exception as e:
+        print(f"⚠️ 讀取設定檔失敗 ({e})，使用{'現有' if cache.current else '預設'}設定。")
+        if cache.current: cache.checked_at = time.time()
+        else: cache.set(DEFAULT_KPI_CONFIG, "default", warnings=[f"讀取設定檔失敗：{e}"])
+    finally:
+        cache.load_seconds = time.perf_counter() - t0
+
+def kpi_layout(config=None):
+    """回傳 KPI 設定的 KpiLayout；未指定或為目前設定時直接取用設定快取中已預先算好的版本。"""
+    current = get_config_cache().current
+    if config is None: return current[1] if current else KpiLayout(DEFAULT_KPI_CONFIG)
+    if current and current[0] is config: return current[1]
+    return KpiLayout(config)
+
+# --- A1 表示法 ---
+# 每日資料位於第 15~45 列 (1~31 日)，KPI 欄位索引 0 對應 B 欄
+DAY_FIRST_ROW = 15
+DAY_LAST_ROW = 45
+KPI_FIRST_COL = 2
+
+def col_letters(col):
+    """1 起始的欄號轉成欄位字母 (1 → A、27 → AA、703 → AAA)。"""
+    if col < 1: raise ValueError(f"欄號必須 >= 1：{col}")
+    letters = ""
+    while col:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+def a1_range(first_col, first_row, last_col, last_row):
+    """1 起始的欄列座標轉成 A1 範圍字串，例如 (2, 15, 30, 45) → 'B15:AD45'。"""
+    return f"{col_letters(first_col)}{first_row}:{col_letters(last_col)}{last_row}"
+
+def kpi_column_spans(config=None):
+    """把 KPI 用到的欄位索引 (0 起始) 合併成連續區段 [(起, 迄), ...]，未使用的欄位不讀。"""
+    spans = []
+    for col in sorted(set(kpi_layout(config).cols.tolist())):
+        if spans and col == spans[-1][1] + 1: spans[-1][1] = col
+        else: spans.append([col, col])
+    return [tuple(span) for span in spans]
+
+def read_kpi_block(ws, first_row, last_row, spans, width):
+    """
+    讀取 first_row~last_row 列中指定的欄位區段，回傳 (列數, width) 的 float64 陣列 (未讀欄位為 0)。
+    單一區段用 ws.get，多個區段用一次 batch_get。
+    """
+    ranges = [a1_range(KPI_FIRST_COL + a, first_row, KPI_FIRST_COL + b, last_row) for a, b in spans]
+    results = [ws.get(ranges[0])] if len(ranges) == 1 else ws.batch_get(ranges)
+    block = np.zeros((last_row - first_row + 1, width))
+    for (a, b), rows in zip(spans, results):
+        rows = list(rows)[:block.shape[0]]
+        if rows: block[:len(rows), a:b + 1] = parse_numeric_block(rows, b - a + 1)
+    return block
+
+# 以下查詢在 API 重試用盡時直接拋出例外，避免把「讀取失敗」誤當成「找不到檔案」
+def get_working_folder_id(drive_service, root_folder_id, date_obj):
+    folder_name = date_obj.strftime("%Y%m")
+    if root_folder_id:
+        # 月份資料夾只在根目錄底下找 (沿用根目錄的索引)
+        files = get_drive_index().find(drive_service, root_folder_id, folder_name)
+    else:
+        query = f"name = '{folder_name}' and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
+        files = drive_execute(drive_service.files().list(q=query, fields="files(id, name, mimeType)")).get('files', [])
+    folder = next((f for f in files if f['mimeType'] == 'application/vnd.google-apps.folder'), None)
+    if folder: return folder['id']
+    else: return root_folder_id 
+
+def get_sheet_file_info(drive_service, filename, folder_id):
+    if folder_id: return get_drive_index().find(drive_service, folder_id, filename)
+    query = f"name = '{filename}' and trashed = false"
+    results = drive_execute(drive_service.files().list(q=query, fields="files(id, name, webViewLink, mimeType, modifiedTime)"))
+    return results.get('files', [])
+
+def safe_float(value):
+    try:
+        if value in [None, "", " ", "-"]: return 0.0
+        clean_val = str(value).replace(",", "").replace("$", "").replace("%", "").replace(" ", "").strip()
+        if not clean_val: return 0.0
+        return float(clean_val)
+    except ValueError: return 0.0
+
+# 向量化數值解析：與 safe_float 逐格結果相同，但整塊一次處理
+NUMERIC_JUNK_PATTERN = r"[,$% ]"
+
+def _float_or_zero(text):
+    try: return float(text)
+    except ValueError: return 0.0
+
+def parse_numeric_block(rows, width=None):
+    """
+    將 ws.get / get_all_values 回傳的不規則二維清單補齊成 (列數, width) 的 float64 陣列。
+    清除規則同 safe_float：去除逗號、$、%、空白；空白與 "-" 視為 0，無法解析者視為 0。
+    """
+    if width is None: width = max((len(r) for r in rows), default=0)
+    if not rows or width == 0: return np.zeros((len(rows), width))
+
+    padded = [list(r[:width]) + [""] * (width - len(r)) for r in rows]
+    text = pd.Series(np.asarray(padded, dtype=object).ravel()).fillna("").astype(str)
+    text = text.str.replace(NUMERIC_JUNK_PATTERN, "", regex=True).str.strip()
+    text = text.mask(text.isin(["", "-"]), "0")
+    flat = text.to_numpy(dtype=object).astype(np.str_)
+
+    # numpy 的字串轉浮點與 float() 完全一致；遇到非數字內容時只對壞格逐一處理
+    try:
+        values = flat.astype(np.float64)
+    except ValueError:
+        bad = pd.to_numeric(text, errors="coerce").isna().to_numpy(copy=True)
+        values = np.zeros(flat.shape)
+        try: values[~bad] = flat[~bad].astype(np.float64)
+        except ValueError: bad[:] = True
+        values[bad] = [_float_or_zero(x) for x in flat[bad]]
+    return values.reshape(len(rows), width)
+
+def reduce_kpi_block(block, config=None):
+    """
+    對 parse_numeric_block 的結果做 KPI 彙整：
+    一般欄位逐日加總，mode=overwrite 欄位取最後一個非 0 值 (全為 0 則為 0)。
+    """
+    layout = kpi_layout(config)
+    keys, cols, overwrite = layout.keys, layout.cols, layout.overwrite
+    if block.shape[0] == 0: return {key: 0 for key in keys}
+    if block.shape[1] <= cols.max():
+        block = np.pad(block, ((0, 0), (0, cols.max() + 1 - block.shape[1])))
+    sub = block[:, cols]
+
+    # cumsum 依序相加，浮點結果與逐列 += 完全相同 (sum 會改用 pairwise 加總)
+    sums = np.cumsum(sub, axis=0)[-1]
+    nonzero = sub != 0
+    last_idx = sub.shape[0] - 1 - np.argmax(nonzero[::-1], axis=0)
+    last = np.where(nonzero.any(axis=0), sub[last_idx, np.arange(len(keys))], 0.0)
+
+    values = np.where(overwrite, last, sums)
+    return dict(zip(keys, values.tolist()))
+
+# --- 全店掃描 ---
+
+def fetch_store_block(client, file_id, store_name, spans, width):
+    """讀取單一門市分頁的每日區塊，回傳 (數值陣列, 耗時秒數, 錯誤訊息)。"""
+    from gspread.exceptions import WorksheetNotFound
+    t0 = time.perf_counter()
+    try:
+        sh = client.open_by_key(file_id)
+        ws = None
+        try: ws = sh.worksheet(store_name)
+        except WorksheetNotFound:
+            try: ws = sh.worksheet("總表")
+            except WorksheetNotFound: pass
+        if ws: block = read_kpi_block(ws, DAY_FIRST_ROW, DAY_LAST_ROW, spans, width)
+        else: block = np.zeros((0, width))
+        return block, time.perf_counter() - t0, None
+    except Exception as e:
+        return None, time.perf_counter() - t0, str(e)
+
+class ScanCache:
+    """
+    全程序共用的單店彙整快取：file_id → (modifiedTime, 設定簽章, 彙整結果, 每日 KPI 矩陣)。
+    檔案的 modifiedTime 與 KPI 設定都沒變時，重新掃描可直接沿用上次結果。
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, file_id, modified_time, config_key):
+        """回傳 (彙整結果, 每日矩陣) 或 None。"""
+        with self._lock:
+            entry = self._entries.get(file_id)
+        if entry and modified_time and entry[0] == modified_time and entry[1] == config_key:
+            return dict(entry[2]), entry[3]
+        return None
+
+    def put(self, file_id, modified_time, config_key, stat, daily):
+        if not modified_time: return
+        with self._lock:
+            self._entries[file_id] = (modified_time, config_key, dict(stat), daily)
+
+    def clear(self):
+        with self._lock: self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+@process_singleton
+def get_scan_cache():
+    return ScanCache()
+
+def float32_to_decimal(values):
+    """
+    float32 陣列轉成 float64，並取回各值的最短十進位表示 (0.38 而非 0.3799999952316284)，
+    讓匯出與入庫的數值與試算表上的一致。
+    """
+    values = np.asarray(values)
+    if values.dtype == np.float32: return values.astype(str).astype(np.float64)
+    return values.astype(np.float64)
+
+class KpiCube:
+    """
+    門市 × 日 × KPI 的每日數值 (float32)，附標籤索引。
+    掃描時保留每日明細，每日趨勢與單日排行都可直接由 cube 計算，不需再呼叫 API；
+    月總計仍由 reduce_kpi_block 以原始 float64 數值計算 (見 scan_month_stores 回傳的 DataFrame)。
+    讀取失敗的門市整列為 NaN。
+    """
+    def __init__(self, month, stores, kpis, values, overwrite):
+        self.month = month
+        self.stores = list(stores)
+        self.kpis = list(kpis)
+        self.days = np.arange(1, values.shape[1] + 1)
+        self.values = values
+        self.overwrite = overwrite
+        self._kpi_index = {k: i for i, k in enumerate(self.kpis)}
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes
+
+    def daily_by_store(self, kpi):
+        """指定 KPI 的 日 × 門市 表。"""
+        return pd.DataFrame(self.values[:, :, self._kpi_index[kpi]].T, index=pd.Index(self.days, name="日"), columns=self.stores)
+
+    def daily_total(self, kpi):
+        """全店每日合計；overwrite 類 (比率) 取當日有數值門市的平均。"""
+        daily = self.daily_by_store(kpi).astype(np.float64)
+        if self.overwrite[self._kpi_index[kpi]]:
+            return daily.where(daily != 0).mean(axis=1).fillna(0.0)
+        return daily.sum(axis=1)
+
+    def day_ranking(self, day, kpi):
+        """指定日期的門市排行 (由高到低)。"""
+        col = self.values[:, day - 1, self._kpi_index[kpi]].astype(np.float64)
+        ranking = pd.DataFrame({"門市": self.stores, kpi: col}).sort_values(kpi, ascending=False, na_position="last")
+        ranking.insert(0, "名次", np.arange(1, len(ranking) + 1))
+        return ranking
+
+def daily_kpi_matrix(block, n_days, config=None):
+    """由 parse_numeric_block 的結果取出 (n_days, KPI 數) 的每日矩陣 (float32)。"""
+    layout = kpi_layout(config)
+    out = np.zeros((n_days, len(layout.keys)), dtype=np.float32)
+    rows = min(n_days, block.shape[0])
+    if rows and block.shape[1]:
+        valid = layout.cols < block.shape[1]
+        out[:rows, valid] = block[:rows, layout.cols[valid]]
+    return out
+
+def kpi_config_key(config=None):
+    """KPI 設定的簽章；欄位或模式改變時，快取的彙整結果即失效。"""
+    return kpi_layout(config).signature
+
+def list_month_store_files(drive_service, date_obj):
+    """
+    重新列表當月資料夾 (一次 API 呼叫，取得最新 modifiedTime)，回傳各門市日報表檔案。
+    API 錯誤直接拋出。
+    """
+    root_id = setting("TARGET_FOLDER_ID")
+    folder_id = get_working_folder_id(drive_service, root_id, date_obj)
+    get_drive_index().invalidate(folder_id)
+    listing = get_drive_index().list_folder(drive_service, folder_id)
+    all_files = [f for files in listing.values() for f in files if f['mimeType'] == 'application/vnd.google-apps.spreadsheet']
+    prefix = date_obj.strftime('%Y_%m')
+    return [f for f in all_files if "店業績日報表" in f['name'] and "(ALL)" not in f['name'] and f['name'].startswith(prefix)]
+
+def store_name_from_file(file_info):
+    return file_info['name'].split('_')[-1].replace('業績日報表', '')
+
+def scan_month_stores(date_obj, max_workers=8, use_cache=True, column_projection=True, progress=None):
+    """
+    並行掃描當月所有門市日報表並彙整，回傳 (DataFrame, 訊息, KpiCube)；找不到資料夾或檔案時 DataFrame 與 cube 為 None。
+    各店讀取在執行緒池中進行，單店失敗不影響其他門市；
+    modifiedTime 未變的門市直接使用 ScanCache 中的上次結果 (一次資料夾列表 + 只讀有變動的門市)。
+    耗時統計放在回傳 DataFrame 的 attrs['scan_stats']；progress(已完成數, 總數, 門市名稱) 供呼叫端顯示進度。
+    """
+    t_start = time.perf_counter()
+    client, drive_service, _ = get_gspread_client()
+    
+    try: valid_files = list_month_store_files(drive_service, date_obj)
+    except Exception as e: return None, f"無法讀取資料夾: {e}", None
+
+    if not valid_files: return None, f"找不到符合 {date_obj.strftime('%Y_%m')}_.+店業績日報表 的檔案", None
+
+    # 整次掃描使用同一份 KPI 設定；投影模式只讀 KPI 用到的欄位區段，否則讀 B 欄到最後一個 KPI 欄
+    layout = kpi_layout()
+    config = layout.config
+    width = layout.max_col + 1
+    spans = kpi_column_spans(config) if column_projection else [(0, layout.max_col)]
+
+    store_names = [store_name_from_file(f) for f in valid_files]
+    aggregated_data = [None] * len(valid_files)
+    store_times, errors = {}, {}
+    scan_cache, config_key = get_scan_cache(), kpi_config_key(config)
+    if not use_cache: scan_cache.clear()
+
+    n_days = calendar.monthrange(date_obj.year, date_obj.month)[1]
+    daily = np.full((len(valid_files), n_days, len(layout.keys)), np.nan, dtype=np.float32)
+
+    pending = []
+    for idx, f in enumerate(valid_files):
+        cached = scan_cache.get(f['id'], f.get('modifiedTime'), config_key)
+        if cached is None: pending.append(idx)
+        else:
+            aggregated_data[idx] = {"門市": store_names[idx], "連結": f['webViewLink'], **cached[0]}
+            daily[idx] = cached[1]
+    from_cache = len(valid_files) - len(pending)
+    workers = max(1, min(int(max_workers), len(pending)))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            submit_in_context(pool, fetch_store_block, client, valid_files[idx]['id'], store_names[idx], spans, width): idx
+            for idx in pending
+        }
+        # 依完成順序回報進度，結果依原檔案順序放回
+        for done, fut in enumerate(as_completed(futures), start=from_cache + 1):
+            idx = futures[fut]
+            store_name = store_names[idx]
+            block, elapsed, err = fut.result()
+            store_times[store_name] = elapsed
+            if err:
+                errors[store_name] = err
+                print(f"⚠️ {store_name} 讀取失敗：{err}")
+            stat = {"門市": store_name, "連結": valid_files[idx]['webViewLink']}
+            if err:
+                # 讀取失敗的門市以 NaN 表示，加總時略過，而不是當成 0
+                stat.update({key: np.nan for key in config})
+            else:
+                kpis = reduce_kpi_block(block, config)
+                daily[idx] = daily_kpi_matrix(block, n_days, config)
+                scan_cache.put(valid_files[idx]['id'], valid_files[idx].get('modifiedTime'), config_key, kpis, daily[idx].copy())
+                stat.update(kpis)
+            aggregated_data[idx] = stat
+            if progress: progress(done, len(valid_files), store_name)
+    
+    wall_time = time.perf_counter() - t_start
+    df = pd.DataFrame(aggregated_data)
+    df.attrs['scan_stats'] = {
+        "wall_time": wall_time, "workers": workers,
+        "store_times": store_times, "errors": errors, "from_cache": from_cache,
+        "config_key": config_key,
+    }
+    msg = f"✅ 掃描完成：{len(valid_files)} 間門市（{from_cache} 間未變動沿用快取，耗時 {wall_time:.1f} 秒，並行 {workers}）"
+    if errors: msg += f"，⚠️ {len(errors)} 間讀取失敗：{'、'.join(errors)}"
+
+    cube = KpiCube(date_obj.strftime('%Y%m'), store_names, layout.keys, daily, layout.overwrite)
+    return df, msg, cube
+
+# --- 人員分頁掃描 ---
+
+NON_STAFF_SHEETS = ["總表", "總計", "Total", "TOTAL", "Log", "設定", "Config"]
+
+def staff_sheet_titles(all_sheets, store_name):
+    """從分頁名稱中排除總表類分頁與店名分頁，剩下的即為人員分頁。"""
+    exclude_list = NON_STAFF_SHEETS + [store_name]
+    return [s for s in all_sheets if s not in exclude_list]
+
+def quote_sheet_title(title):
+    return "'" + title.replace("'", "''") + "'"
+
+def fetch_store_staff_blocks(client, file_id, store_name, spans, width):
+    """
+    讀取單一門市檔案中所有人員分頁的每日區塊，只用兩次 API 呼叫：
+    一次 metadata 取得分頁名稱，一次 values.batchGet 取回所有人員分頁。
+    回傳 ({人員: 數值陣列}, 耗時秒數, 錯誤訊息)。
+    """
+    t0 = time.perf_counter()
+    try:
+        metadata = client.http_client.fetch_sheet_metadata(file_id)
+        titles = [sheet['properties']['title'] for sheet in metadata.get('sheets', [])]
+        staff = staff_sheet_titles(titles, store_name)
+        if not staff: return {}, time.perf_counter() - t0, None
+
+        ranges = [
+            f"{quote_sheet_title(name)}!{a1_range(KPI_FIRST_COL + a, DAY_FIRST_ROW, KPI_FIRST_COL + b, DAY_LAST_ROW)}"
+            for name in staff for a, b in spans
+        ]
+        value_ranges = client.http_client.values_batch_get(file_id, ranges).get('valueRanges', [])
+        n_rows = DAY_LAST_ROW - DAY_FIRST_ROW + 1
+        blocks = {}
+        for i, name in enumerate(staff):
+            block = np.zeros((n_rows, width))
+            for j, (a, b) in enumerate(spans):
+                vr = value_ranges[i * len(spans) + j] if i * len(spans) + j < len(value_ranges) else {}
+                rows = vr.get('values', [])[:n_rows]
+                if rows: block[:len(rows), a:b + 1] = parse_numeric_block(rows, b - a + 1)
+            blocks[name] = block
+        return blocks, time.perf_counter() - t0, None
+    except Exception as e:
+        return None, time.perf_counter() - t0, str(e)
+
+def scan_month_staff(date_obj, max_workers=8, use_cache=True, column_projection=True, progress=None):
+    """
+    全公司人員層級掃描：每間門市只呼叫兩次 API (metadata + batchGet)，API 次數與門市數成正比，與人數無關。
+    回傳 (DataFrame, 訊息, daily)；daily 為 {(門市, 人員): (日數, KPI 數) float32 每日矩陣}，與 KpiCube 同樣的欄位順序。
+    讀取失敗的門市記在 DataFrame 的 attrs['scan_stats']['errors']；progress 同 scan_month_stores。
+    """
+    t_start = time.perf_counter()
+    client, drive_service, _ = get_gspread_client()
+    try: valid_files = list_month_store_files(drive_service, date_obj)
+    except Exception as e: return None, f"無法讀取資料夾: {e}", None
+    if not valid_files: return None, f"找不到符合 {date_obj.strftime('%Y_%m')}_.+店業績日報表 的檔案", None
+
+    layout = kpi_layout()
+    config = layout.config
+    width = layout.max_col + 1
+    spans = kpi_column_spans(config) if column_projection else [(0, layout.max_col)]
+    n_days = calendar.monthrange(date_obj.year, date_obj.month)[1]
+    # 與門市總表共用 ScanCache，以 ("staff", file_id) 為鍵區分
+    scan_cache, config_key = get_scan_cache(), kpi_config_key(config)
+    if not use_cache: scan_cache.clear()
+
+    rows, daily, errors, from_cache = [], {}, {}, 0
+    results = {}
+    pending = []
+    for f in valid_files:
+        cached = scan_cache.get(("staff", f['id']), f.get('modifiedTime'), config_key)
+        if cached is None: pending.append(f)
+        else:
+            results[f['id']] = cached
+            from_cache += 1
+
+    workers = max(1, min(int(max_workers), len(pending)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {submit_in_context(pool, fetch_store_staff_blocks, client, f['id'], store_name_from_file(f), spans, width): f for f in pending}
+        for done, fut in enumerate(as_completed(futures), start=from_cache + 1):
+            f = futures[fut]
+            blocks, _, err = fut.result()
+            if err:
+                errors[store_name_from_file(f)] = err
+                print(f"⚠️ {store_name_from_file(f)} 人員分頁讀取失敗：{err}")
+            else:
+                kpis = {name: reduce_kpi_block(block, config) for name, block in blocks.items()}
+                matrices = {name: daily_kpi_matrix(block, n_days, config) for name, block in blocks.items()}
+                scan_cache.put(("staff", f['id']), f.get('modifiedTime'), config_key, kpis, matrices)
+                results[f['id']] = (kpis, matrices)
+            if progress: progress(done, len(valid_files), store_name_from_file(f))
+
+    for f in valid_files:
+        if f['id'] not in results: continue
+        store_name = store_name_from_file(f)
+        kpis, matrices = results[f['id']]
+        for name, stat in kpis.items():
+            rows.append({"門市": store_name, "人員": name, **stat})
+            daily[(store_name, name)] = matrices[name]
+
+    df = pd.DataFrame(rows, columns=["門市", "人員"] + layout.keys)
+    wall_time = time.perf_counter() - t_start
+    df.attrs['scan_stats'] = {"wall_time": wall_time, "workers": workers, "errors": errors, "from_cache": from_cache}
+    msg = f"✅ 人員排行完成：{len(valid_files)} 間門市、{len(df)} 位人員（{from_cache} 間沿用快取，耗時 {wall_time:.1f} 秒）"
+    if errors: msg += f"，⚠️ {len(errors)} 間讀取失敗：{'、'.join(errors)}"
+    return df, msg, daily
+
+# --- 人員名單 (背景預載) ---
+
+class RosterCache:
+    """各門市各月份的人員名單，所有 session 共用；由 RosterWarmer 在背景定期更新。"""
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self._entries = {}  # (store, 'YYYY_MM') -> (名單, modifiedTime, fetched_at)
+        self._lock = threading.Lock()
+
+    def get(self, store, month_key):
+        with self._lock: entry = self._entries.get((store, month_key))
+        if entry and time.time() - entry[2] <= self.max_age: return entry[0]
+        return None
+
+    def modified_time(self, store, month_key):
+        with self._lock: entry = self._entries.get((store, month_key))
+        return entry[1] if entry else None
+
+    def put(self, store, month_key, roster, modified_time=None):
+        with self._lock: self._entries[(store, month_key)] = (roster, modified_time, time.time())
+
+    def touch(self, store, month_key):
+        with self._lock:
+            roster, modified_time, _ = self._entries[(store, month_key)]
+            self._entries[(store, month_key)] = (roster, modified_time, time.time())
+
+    def __len__(self): return len(self._entries)
+
+@process_singleton
+def get_roster_cache():
+    return RosterCache(int(setting("ROSTER_REFRESH_SECONDS", 300)) * 2)
+
+def fetch_roster(client, file_id, store_name):
+    """一次 metadata 呼叫取得檔案的所有分頁名稱並轉成人員名單。"""
+    metadata = client.http_client.fetch_sheet_metadata(file_id)
+    return staff_sheet_titles([sheet['properties']['title'] for sheet in metadata.get('sheets', [])], store_name)
+
+def warm_month_rosters(date_obj, store_names, max_workers=None):
+    """
+    列表一次當月資料夾，並行取回各門市的人員名單放入 RosterCache (並行數預設為設定值 ROSTER_MAX_WORKERS 或 8)。
+    modifiedTime 未變的檔案只更新時間戳記，不重新讀取；沒有檔案的門市記為空名單。
+    回傳讀取失敗的 {門市: 錯誤}。
+    """
+    client, drive_service, _ = get_gspread_client()
+    cache = get_roster_cache()
+    month_key = date_obj.strftime('%Y_%m')
+    files = {store_name_from_file(f): f for f in list_month_store_files(drive_service, date_obj)}
+    to_fetch = []
+    for store in store_names:
+        f = files.get(store)
+        if f is None: cache.put(store, month_key, [])
+        elif cache.get(store, month_key) is not None and cache.modified_time(store, month_key) == f.get('modifiedTime'):
+            cache.touch(store, month_key)
+        else: to_fetch.append(f)
+
+    errors = {}
+    if not to_fetch: return errors
+    max_workers = max_workers or int(setting("ROSTER_MAX_WORKERS", 8))
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(to_fetch)))) as executor:
+        futures = {submit_in_context(executor, fetch_roster, client, f['id'], store_name_from_file(f)): f for f in to_fetch}
+        for future in as_completed(futures):
+            f = futures[future]
+            store = store_name_from_file(f)
+            try: cache.put(store, month_key, future.result(), f.get('modifiedTime'))
+            except Exception as e: errors[store] = e
+    return errors
+
+class RosterWarmer(threading.Thread):
+    """程序啟動時與每 ROSTER_REFRESH_SECONDS 秒預載本月與上月所有門市的人員名單。"""
+    def __init__(self, store_names, interval):
+        super().__init__(daemon=True, name="roster-warmer")
+        self.store_names = store_names
+        self.interval = interval
+        self.last_run = None
+        self.last_seconds = 0.0
+        self.last_errors = {}
+
+    def warm_once(self):
+        t0 = time.perf_counter()
+        today = date.today()
+        prev = today.replace(day=1) - timedelta(days=1)
+        errors = {}
+        for month in (today, prev):
+            try:
+                with trace_action("背景預載人員名單"): errors.update(warm_month_rosters(month, self.store_names))
+            except Exception as e: errors[month.strftime('%Y_%m')] = e
+        self.last_errors = errors
+        self.last_seconds = time.perf_counter() - t0
+        self.last_run = datetime.now()
+
+    def run(self):
+        while True:
+            self.warm_once()
+            time.sleep(self.interval)
+
+# --- 門市總表讀取 (精簡型別 DataFrame、跨 session 快照快取) ---
+
+def make_columns_unique(columns):
+    seen = {}
+    new_columns = []
+    for i, col in enumerate(columns):
+        col_name = str(col).strip() if str(col).strip() else f"Column_{i}"
+        if col_name in seen:
+            seen[col_name] += 1
+            new_columns.append(f"{col_name}_{seen[col_name]}")
+        else:
+            seen[col_name] = 0
+            new_columns.append(col_name)
+    return new_columns
+
+def find_kpi_header_row(data, config=None):
+    """在表格上方找出含最多 KPI 名稱 (或顯示標籤) 的列作為表頭；至少要對到 3 個才算，否則回傳 None。"""
+    config = config or kpi_layout().config
+    names = set(config) | {v['label'] for v in config.values()}
+    best, best_hits = None, 0
+    for i, row in enumerate(data[:DAY_FIRST_ROW]):
+        hits = sum(1 for cell in row if str(cell).strip() in names)
+        if hits > best_hits: best, best_hits = i, hits
+    return best if best_hits >= min(3, len(names)) else None
+
+def _compact_numeric(values, allow_int):
+    """數值欄位：全為整數且在 int32 範圍內用 int32，其餘用 float32。"""
+    if allow_int and len(values) and np.all(np.mod(values, 1) == 0) and np.abs(values).max() < 2 ** 31:
+        return values.astype(np.int32)
+    return values.astype(np.float32)
+
+def _looks_numeric(raw):
+    text = pd.Series(raw, dtype=object).fillna("").astype(str).str.replace(NUMERIC_JUNK_PATTERN, "", regex=True).str.strip()
+    text = text[~text.isin(["", "-"])]
+    return not text.empty and pd.to_numeric(text, errors="coerce").notna().all()
+
+def typed_kpi_frame(data, config=None):
+    """
+    將 get_all_values 的字串表格轉成精簡型別的 DataFrame。
+    以 KPI 設定找出表頭列；找不到時直接取第 15~45 列的 A 欄 (日期) 與各 KPI 欄。
+    KPI 欄依類型轉 int32/float32，其餘欄位數字轉 float32、重複標籤轉 category，並去除尾端的空白列與空白欄。
+    """
+    config = config or kpi_layout().config
+    label_to_key = {v['label']: k for k, v in config.items()}
+    header_idx = find_kpi_header_row(data, config)
+    if header_idx is not None:
+        width = max((len(r) for r in data[header_idx:]), default=0)
+        headers = make_columns_unique(list(data[header_idx]) + [""] * (width - len(data[header_idx])))
+        body = [list(r) + [""] * (width - len(r)) for r in data[header_idx + 1:]]
+    else:
+        layout = kpi_layout(config)
+        positions = [0] + [KPI_FIRST_COL - 1 + c for c in layout.cols.tolist()]
+        headers = ["日期"] + layout.keys
+        body = [[row[p] if p < len(row) else "" for p in positions] for row in data[DAY_FIRST_ROW - 1:DAY_LAST_ROW]]
+
+    # 去除尾端空白列；空白欄只在表頭也是空白 (Column_n) 時才去除
+    while body and not any(str(c).strip() for c in body[-1]): body.pop()
+    keep = [j for j, h in enumerate(headers)
+            if not h.startswith("Column_") or any(str(r[j]).strip() for r in body)]
+    headers = [headers[j] for j in keep]
+    body = [[r[j] for j in keep] for r in body]
+    if not body: return pd.DataFrame(columns=headers)
+
+    block = parse_numeric_block(body, len(headers))
+    columns = {}
+    for j, name in enumerate(headers):
+        key = label_to_key.get(name, name)
+        raw = [r[j] for r in body]
+        if key in config:
+            columns[name] = _compact_numeric(block[:, j], config[key]['type'] in ('int', 'money'))
+        elif _looks_numeric(raw):
+            columns[name] = _compact_numeric(block[:, j], True)
+        else:
+            col = pd.Series(raw, dtype=object).fillna("").astype(str)
+            columns[name] = col.astype("category") if col.nunique() <= len(col) // 2 else col
+    return pd.DataFrame(columns)
+
+def _snapshot_nbytes(value):
+    if isinstance(value, pd.DataFrame): return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, np.ndarray): return value.nbytes
+    if isinstance(value, tuple): return sum(_snapshot_nbytes(v) for v in value)
+    return sys.getsizeof(value)
+
+class SnapshotCache:
+    """
+    依位元組上限淘汰的 LRU 快取，鍵為 (file_id, 範圍, modifiedTime)，所有 session 共用同一份資料。
+    同一個鍵同時有多個請求時只會讀取一次，其餘請求等待同一個結果。
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = self.collapsed = 0
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+        self._inflight = {}            # key -> Future
+        self._lock = threading.Lock()
+
+    def get_or_fetch(self, key, fetch):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            flight = self._inflight.get(key)
+            owner = flight is None
+            if owner:
+                flight = self._inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.collapsed += 1
+        if not owner: return flight.result()
+
+        try:
+            value = fetch()
+        except Exception as e:
+            with self._lock: self._inflight.pop(key, None)
+            flight.set_exception(e)
+            raise
+        with self._lock:
+            self._put(key, value)
+            self._inflight.pop(key, None)
+        flight.set_result(value)
+        return value
+
+    def _put(self, key, value):
+        nbytes = _snapshot_nbytes(value)
+        if nbytes > self.max_bytes: return
+        if key in self._entries: self.bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (value, nbytes)
+        self.bytes += nbytes
+        while self.bytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.bytes -= evicted
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions, "collapsed": self.collapsed,
+            }
+
+@process_singleton
+def get_snapshot_cache():
+    return SnapshotCache(int(setting("SNAPSHOT_CACHE_MB", 64)) * 1024 * 1024)
+
+def read_sheet_robust_v13(store, date_obj):
+    """
+    讀取門市總表分頁並轉成精簡型別 DataFrame。
+    以 (file_id, 分頁, modifiedTime) 為鍵經過 SnapshotCache：檔案未變動時所有 session 共用同一份快照，
+    每次只多一次 Drive modifiedTime 查詢。
+    """
+    from gspread.exceptions import WorksheetNotFound
+    root_id = setting("TARGET_FOLDER_ID")
+    client, drive_service, _ = get_gspread_client()
+    filename = f"{date_obj.year}_{date_obj.month:02d}_{store}業績日報表"
+    try:
+        folder_id = get_working_folder_id(drive_service, root_id, date_obj)
+        files = get_sheet_file_info(drive_service, filename, folder_id)
+    except Exception as e: return None, f"無法讀取資料夾: {e}", None
+    target_file = next((f for f in files if "google-apps.spreadsheet" in f['mimeType']), None)
+    if not target_file: return None, f"找不到檔案：{filename}", None
+
+    def fetch():
+        sh = client.open_by_key(target_file['id'])
+        target_ws = None
+        try: target_ws = sh.worksheet(store)
+        except WorksheetNotFound:
+            try: target_ws = sh.worksheet("總表")
+            except WorksheetNotFound: pass
+        if not target_ws: return None
+        return typed_kpi_frame(target_ws.get_all_values())
+
+    try:
+        meta = drive_execute(drive_service.files().get(fileId=target_file['id'], fields="modifiedTime"))
+        df = get_snapshot_cache().get_or_fetch((target_file['id'], f"{store}!store-view", meta.get('modifiedTime')), fetch)
+        if df is not None: return df, filename, target_file['webViewLink']
+        else: return None, "找不到店名或總表分頁", target_file['webViewLink']
+    except Exception as e: return None, str(e), None
+
+# --- 單列寫入與上傳佇列 (write-behind) ---
+
+# 上傳佇列的處理週期與重試設定 (佇列路徑讀自設定值 WRITE_QUEUE_PATH)
+QUEUE_FLUSH_INTERVAL = 2.0
+QUEUE_MAX_ATTEMPTS = 6
+QUEUE_BACKOFF_BASE = 5.0
+QUEUE_BACKOFF_MAX = 300.0
+
+class RowLocks:
+    """同一程序內，以 (檔案, 分頁, 列) 為單位的寫入鎖，避免多個 session 同時改同一列。"""
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+@process_singleton
+def get_row_locks():
+    return RowLocks()
+
+def merged_row_values(current, data_dict):
+    """
+    依目前整列數值 (parse_numeric_block 的單列結果) 計算寫入後的值，回傳 {KPI 欄位索引: 新值}。
+    overwrite 欄位直接覆寫，其餘欄位為 原值 + 新值。
+    """
+    config = kpi_layout().config
+    values = {}
+    for field, new_val in data_dict.items():
+        if field in config and new_val is not None:
+            cfg = config[field]
+            if cfg.get('mode') == 'overwrite':
+                values[cfg['col']] = new_val
+            else:
+                values[cfg['col']] = float(current[cfg['col']]) + new_val
+    return values
+
+def build_row_updates(target_row, cells):
+    """將 merged_row_values 的結果 {KPI 欄位索引: 值} 轉成 ws.batch_update 用的逐格更新。"""
+    return [{'range': f"{col_letters(col + KPI_FIRST_COL)}{target_row}", 'values': [[val]]} for col, val in cells.items()]
+
+def target_applied(current, target):
+    """整列是否已等於先前記下的目標值 (只記會改變的累加欄位，overwrite 欄位重寫不會重複計算)。"""
+    return bool(target) and all(abs(float(current[col]) - val) < 1e-6 for col, val in target.items())
+
+def write_row_to_sheet(store, staff, date_obj, data_dict, prior=(), record_target=None):
+    """
+    直接寫入試算表 (由寫入佇列的背景 flusher 呼叫)。
+    讀取整列 → 本地計算累加 → 一次 batch_update 寫回。
+    讀取到寫回之間只有本程序內的列鎖與單一 flusher 保護；其他程序或有人直接編輯試算表時，
+    在這段期間寫入的數值會被覆蓋。
+
+    佇列重試時 prior 為先前嘗試記下的 [(目標值, data_dict)]：整列已等於目標值代表那次其實已寫入
+    (寫入後、標記完成前中斷，或伺服器已套用但回應錯誤)，不再重複累加。
+    record_target(目標值, 已寫入的 prior 索引) 在寫回前呼叫，讓佇列先記下這次會改變的累加欄位 {欄位索引: 寫入後的值}。
+    """
+    root_id = setting("TARGET_FOLDER_ID")
+    client, drive_service, _ = get_gspread_client()
+    folder_id = get_working_folder_id(drive_service, root_id, date_obj)
+    
+    filename = f"{date_obj.year}_{date_obj.month:02d}_{store}業績日報表"
+    files = get_sheet_file_info(drive_service, filename, folder_id)
+    target_file = next((f for f in files if "google-apps.spreadsheet" in f['mimeType']), None)
+    
+    if not target_file: return f"❌ 找不到檔案：{filename}"
+    
+    config = kpi_layout().config
+    fields = [k for d in [data_dict] + [d for _, d in prior] for k, v in d.items() if k in config and v is not None]
+    if not fields: return f"✅ 寫入成功：{filename}"
+    width = max(config[k]['col'] for k in fields) + 1
+    accumulate = {cfg['col'] for cfg in config.values() if cfg.get('mode') != 'overwrite'}
+    
+    try:
+        sh = client.open_by_key(target_file['id'])
+        ws = sh.worksheet(staff)
+        target_row = DAY_FIRST_ROW + (date_obj.day - 1)
+        row_range = a1_range(KPI_FIRST_COL, target_row, KPI_FIRST_COL + width - 1, target_row)
+        
+        with get_row_locks().get((target_file['id'], staff, target_row)):
+            current = parse_numeric_block(list(ws.get(row_range))[:1] or [[]], width)[0]
+            applied = [i for i, (target, _) in enumerate(prior) if target_applied(current, target)]
+            pending = [d for i, (_, d) in enumerate(prior) if i not in applied] + [data_dict]
+            cells = merged_row_values(current, coalesce_submissions(pending))
+            if record_target:
+                record_target({col: val for col, val in cells.items() if col in accumulate and val != current[col]}, applied)
+            if cells: ws.batch_update(build_row_updates(target_row, cells))
+        return f"✅ 寫入成功：{filename}"
+    except Exception as e: return f"❌ 寫入錯誤：{e}"
+
+class WriteQueue:
+    """
+    以 SQLite 為日誌的上傳佇列。送出時只寫入本機檔案即回傳，
+    由背景 WriteFlusher 合併同一列的待寫資料後寫入 Google Sheets，程式重啟後未完成項目仍會繼續。
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS submissions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at REAL NOT NULL,
+            store TEXT NOT NULL,
+            staff TEXT NOT NULL,
+            work_date TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            done_at REAL,
+            target TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_submissions_due ON submissions (status, next_attempt_at);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(self.SCHEMA)
+            # 舊版佇列檔沒有 target 欄
+            if "target" not in {row[1] for row in conn.execute("PRAGMA table_info(submissions)")}:
+                conn.execute("ALTER TABLE submissions ADD COLUMN target TEXT")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def enqueue(self, store, staff, date_obj, data_dict):
+        with self._connect() as conn:
+            cur = conn.execute(
+                "INSERT INTO submissions (created_at, store, staff, work_date, payload) VALUES (?, ?, ?, ?, ?)",
+                (time.time(), store, staff, date_obj.isoformat(), json.dumps(data_dict, ensure_ascii=False)),
+            )
+            return cur.lastrowid
+
+    def due(self, now=None):
+        """到期的待寫項目；同一列只要有一筆到期，仍在退避中的同列項目也一起取出，重試比對才不會被較新的寫入蓋過。"""
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT id, store, staff, work_date, payload, attempts, target FROM submissions "
+                "WHERE status = 'pending' AND (store, staff, work_date) IN ("
+                "SELECT store, staff, work_date FROM submissions WHERE status = 'pending' AND next_attempt_at <= ?) "
+                "ORDER BY id",
+                (now or time.time(),),
+            ).fetchall()
+
+    def record_target(self, ids, target):
+        """寫回試算表前記下這次的目標值；重試時整列已等於它就代表上次其實已寫入。"""
+        with self._connect() as conn:
+            conn.executemany("UPDATE submissions SET target = ? WHERE id = ?",
+                             [(json.dumps(target), i) for i in ids])
+
+    def mark_done(self, ids):
+        with self._connect() as conn:
+            conn.executemany("UPDATE submissions SET status = 'done', done_at = ?, last_error = NULL WHERE id = ?",
+                             [(time.time(), i) for i in ids])
+
+    def mark_attempt_failed(self, ids, attempts, error):
+        """記錄失敗；未達上限者以指數退避 + 抖動安排下次重試，達上限者標記為 failed。"""
+        status = 'failed' if attempts >= QUEUE_MAX_ATTEMPTS else 'pending'
+        delay = min(QUEUE_BACKOFF_BASE * 2 ** (attempts - 1), QUEUE_BACKOFF_MAX) * random.uniform(1.0, 1.5)
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE submissions SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                [(status, attempts, time.time() + delay, error, i) for i in ids],
+            )
+
+    def retry_failed(self):
+        with self._connect() as conn:
+            conn.execute("UPDATE submissions SET status = 'pending', attempts = 0, next_attempt_at = 0 WHERE status = 'failed'")
+
+    def counts(self):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM submissions GROUP BY status").fetchall()
+        return {status: n for status, n in rows}
+
+    def timings(self, since_id=0):
+        """已寫入項目的排入與寫完時間 (epoch 秒)，供壓力測試統計寫入延遲。"""
+        with self._connect() as conn:
+            return pd.read_sql_query(
+                "SELECT id, created_at, done_at FROM submissions WHERE status = 'done' AND id > ? ORDER BY id",
+                conn, params=[since_id],
+            )
+
+    def items(self, statuses=('pending', 'failed')):
+        marks = ",".join("?" * len(statuses))
+        with self._connect() as conn:
+            return pd.read_sql_query(
+                f"SELECT id, store AS 門市, staff AS 人員, work_date AS 日期, status AS 狀態, attempts AS 嘗試次數, "
+                f"last_error AS 錯誤訊息 FROM submissions WHERE status IN ({marks}) ORDER BY id",
+                conn, params=list(statuses),
+            )
+
+def coalesce_submissions(payloads):
+    """將同一列的多筆送出合併：累加欄位加總，overwrite 欄位取最後一筆。"""
+    config = kpi_layout().config
+    merged = {}
+    for data_dict in payloads:
+        for field, val in data_dict.items():
+            if field not in config or val is None: continue
+            if config[field].get('mode') == 'overwrite' or field not in merged:
+                merged[field] = val
+            else:
+                merged[field] += val
+    return merged
+
+class WriteFlusher(threading.Thread):
+    """背景執行緒：定期取出到期的佇列項目，依 (門市, 人員, 日期) 合併成一次寫入。"""
+    def __init__(self, queue, writer, interval=QUEUE_FLUSH_INTERVAL):
+        super().__init__(name="kpi-write-flusher", daemon=True)
+        self.queue = queue
+        self.writer = writer
+        self.interval = interval
+        self._wake = threading.Event()
+
+    def wake(self):
+        self._wake.set()
+
+    def flush_once(self):
+        groups = {}
+        for item_id, store, staff, work_date, payload, attempts, target in self.queue.due():
+            group = groups.setdefault((store, staff, work_date),
+                                      {"ids": [], "payloads": [], "prior": {}, "attempts": 0, "confirmed": []})
+            group["ids"].append(item_id)
+            # 已記下目標值的項目依目標值分組，由 writer 比對整列判斷上次是否其實已寫入
+            if target is None: group["payloads"].append(json.loads(payload))
+            else:
+                prior = group["prior"].setdefault(target, {"ids": [], "payloads": []})
+                prior["ids"].append(item_id)
+                prior["payloads"].append(json.loads(payload))
+            group["attempts"] = max(group["attempts"], attempts)
+
+        for (store, staff, work_date), group in groups.items():
+            prior = [({int(col): val for col, val in json.loads(target).items()}, coalesce_submissions(p["payloads"]))
+                     for target, p in group["prior"].items()]
+            try:
+                # 佇列寫入由「確認上傳」觸發，但在背景執行緒完成，另列一個動作
+                with trace_action("確認上傳 (背景寫入)"):
+                    msg = self.writer(store, staff, date.fromisoformat(work_date), coalesce_submissions(group["payloads"]),
+                                      prior, functools.partial(self._record_target, group))
+            except Exception as e:
+                msg = f"❌ 寫入錯誤：{e}"
+            ids = [i for i in group["ids"] if i not in group["confirmed"]]
+            if "✅" in msg: self.queue.mark_done(ids)
+            else: self.queue.mark_attempt_failed(ids, group["attempts"] + 1, msg)
+        return len(groups)
+
+    def _record_target(self, group, target, applied):
+        """writer 寫回前呼叫：確認上次已寫入的項目直接完成，其餘項目記下這次的目標值。"""
+        priors = list(group["prior"].values())
+        group["confirmed"] = [i for k in applied for i in priors[k]["ids"]]
+        if group["confirmed"]: self.queue.mark_done(group["confirmed"])
+        self.queue.record_target([i for i in group["ids"] if i not in group["confirmed"]], target)
+
+    def run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try: self.flush_once()
+            except Exception as e: print(f"⚠️ 寫入佇列處理失敗：{e}")
+
+@process_singleton
+def get_write_queue():
+    queue = WriteQueue(setting("WRITE_QUEUE_PATH", "write_queue.sqlite3"))
+    flusher = WriteFlusher(queue, write_row_to_sheet)
+    flusher.start()
+    return queue, flusher
+
+def update_google_sheet_robust(store, staff, date_obj, data_dict):
+    """將送出資料寫入本機佇列後立即回傳，實際寫入由背景 flusher 完成。"""
+    queue, flusher = get_write_queue()
+    queue.enqueue(store, staff, date_obj, data_dict)
+    flusher.wake()
+    filename = f"{date_obj.year}_{date_obj.month:02d}_{store}業績日報表"
+    return f"✅ 已排入上傳佇列：{filename}"
+
+# --- 版本化快照 (排程預先彙整) ---
+
+SNAPSHOT_FORMAT = 1
+
+def _signature_json(config_key):
+    return [list(k) for k in config_key]
+
+def write_snapshot(snapshot_dir, df, cube, msg, keep=10):
+    """
+    將一次全店掃描寫成版本化快照：<snapshot_dir>/<YYYYMM>/<版本>/ 內含
+    summary.parquet (門市月總計)、daily.parquet (門市 × 日 × KPI) 與 meta.json。
+    整個版本目錄寫完後才以 os.replace 更新 LATEST，讀取端不會讀到寫一半的版本；只保留最新 keep 個版本。
+    回傳版本目錄路徑。
+    """
+    created = datetime.now()
+    version = created.strftime("%Y%m%dT%H%M%S%f")
+    month_dir = os.path.join(snapshot_dir, cube.month)
+    tmp_dir = os.path.join(month_dir, f".{version}.tmp")
+    os.makedirs(tmp_dir)
+
+    stats = dict(df.attrs.get('scan_stats', {}))
+    summary = df.copy()
+    summary.attrs = {}
+    summary.to_parquet(os.path.join(tmp_dir, "summary.parquet"), index=False)
+    index = pd.MultiIndex.from_product([cube.stores, cube.days], names=["門市", "日"])
+    pd.DataFrame(cube.values.reshape(-1, len(cube.kpis)), index=index, columns=cube.kpis).to_parquet(os.path.join(tmp_dir, "daily.parquet"))
+
+    meta = {
+        "format": SNAPSHOT_FORMAT, "version": version, "month": cube.month, "created_at": created.timestamp(),
+        "msg": msg, "stores": cube.stores, "kpis": cube.kpis, "overwrite": cube.overwrite.tolist(),
+        "config_key": _signature_json(stats.pop("config_key", ())), "scan_stats": stats,
+    }
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_dir, os.path.join(month_dir, version))
+
+    pointer = os.path.join(month_dir, "LATEST")
+    with open(pointer + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"version": version, "created_at": meta["created_at"]}, f)
+    os.replace(pointer + ".tmp", pointer)
+
+    versions = sorted(d for d in os.listdir(month_dir) if not d.startswith(".") and not d.startswith("LATEST"))
+    for old in versions[:-keep] if keep else []:
+        shutil.rmtree(os.path.join(month_dir, old), ignore_errors=True)
+    return os.path.join(month_dir, version)
+
+def latest_snapshot_info(snapshot_dir, month_key):
+    """讀取 LATEST 指標 {'version', 'created_at'}；沒有快照時回傳 None。"""
+    try:
+        with open(os.path.join(snapshot_dir, month_key, "LATEST"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def load_latest_snapshot(snapshot_dir, month_key, config_key=None):
+    """
+    載入最新快照，回傳與全店掃描結果相同格式的 {'cube', 'df', 'msg', 'scanned_at'} (另含 'source'、'version')。
+    沒有快照、檔案損壞或快照的 KPI 設定與 config_key 不同時回傳 None。
+    """
+    info = latest_snapshot_info(snapshot_dir, month_key)
+    if not info: return None
+    version_dir = os.path.join(snapshot_dir, month_key, info["version"])
+    try:
+        with open(os.path.join(version_dir, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        if config_key is not None and meta.get("config_key") != _signature_json(config_key): return None
+        df = pd.read_parquet(os.path.join(version_dir, "summary.parquet"))
+        daily = pd.read_parquet(os.path.join(version_dir, "daily.parquet"))
+    except (OSError, ValueError) as e:
+        print(f"⚠️ 快照 {version_dir} 讀取失敗：{e}")
+        return None
+    df.attrs['scan_stats'] = meta["scan_stats"]
+    values = daily[meta["kpis"]].to_numpy(dtype=np.float32).reshape(len(meta["stores"]), -1, len(meta["kpis"]))
+    cube = KpiCube(meta["month"], meta["stores"], meta["kpis"], values, np.array(meta["overwrite"], dtype=bool))
+    return {"cube": cube, "df": df, "msg": meta["msg"], "scanned_at": meta["created_at"], "source": "snapshot", "version": meta["version"]}
+
+# --- 本機歷史 KPI 資料庫 ---
+
+# 門市總表分頁的數值在歷史資料庫中以人員 '' 儲存
+STORE_LEVEL = ""
+
+def month_is_closed(month_key, today=None, grace_days=5):
+    """月份結束超過 grace_days 天 (留給月初補登) 即視為已結帳，匯入後不再向 Sheets 讀取。"""
+    today = today or date.today()
+    year, month = int(month_key[:4]), int(month_key[4:])
+    return (today - date(year, month, calendar.monthrange(year, month)[1])).days > grace_days
+
+class KpiHistory:
+    """
+    本機歷史 KPI 資料庫 (SQLite 長格式：月份 / 門市 / 人員 / 日 / KPI / 數值，只存非 0 值)。
+    每個月份整批取代寫入；已結帳的月份匯入後即不再掃描，多月查詢完全在本機完成。
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS kpi_daily (
+            month TEXT NOT NULL,
+            store TEXT NOT NULL,
+            staff TEXT NOT NULL,
+            day INTEGER NOT NULL,
+            kpi TEXT NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (month, store, staff, day, kpi)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_kpi_daily_kpi ON kpi_daily (kpi, month, store, staff);
+        CREATE TABLE IF NOT EXISTS months (
+            month TEXT PRIMARY KEY,
+            closed INTEGER NOT NULL,
+            rows INTEGER NOT NULL,
+            ingested_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS kpis (
+            kpi TEXT PRIMARY KEY,
+            overwrite INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def months(self):
+        with self._connect() as conn:
+            return pd.read_sql_query("SELECT month, closed, rows, ingested_at FROM months ORDER BY month", conn)
+
+    def is_closed(self, month_key):
+        with self._connect() as conn:
+            row = conn.execute("SELECT closed FROM months WHERE month = ?", (month_key,)).fetchone()
+        return bool(row and row[0])
+
+    def overwrite_kpis(self):
+        with self._connect() as conn:
+            return {kpi for kpi, flag in conn.execute("SELECT kpi, overwrite FROM kpis") if flag}
+
+    def ingest(self, cube, staff_daily, closed):
+        """
+        以一個交易取代 cube.month 的所有資料：門市總表來自 KpiCube，人員分頁來自 scan_month_staff 的 daily。
+        回傳寫入筆數。
+        """
+        def nonzero_rows(store, staff, matrix):
+            matrix = np.nan_to_num(float32_to_decimal(matrix))
+            days, cols = np.nonzero(matrix)
+            return [(cube.month, store, staff, int(d) + 1, cube.kpis[c], float(matrix[d, c])) for d, c in zip(days, cols)]
+
+        rows = []
+        for i, store in enumerate(cube.stores):
+            rows += nonzero_rows(store, STORE_LEVEL, cube.values[i])
+        for (store, staff), matrix in (staff_daily or {}).items():
+            rows += nonzero_rows(store, staff, matrix)
+
+        with self._connect() as conn:
+            conn.execute("DELETE FROM kpi_daily WHERE month = ?", (cube.month,))
+            conn.executemany("INSERT OR REPLACE INTO kpi_daily VALUES (?, ?, ?, ?, ?, ?)", rows)
+            conn.execute("INSERT OR REPLACE INTO months VALUES (?, ?, ?, ?)", (cube.month, int(closed), len(rows), time.time()))
+            conn.executemany("INSERT OR REPLACE INTO kpis VALUES (?, ?)",
+                             [(k, int(flag)) for k, flag in zip(cube.kpis, cube.overwrite.tolist())])
+        return len(rows)
+
+    def iter_month_rows(self, month_key, kpis):
+        """
+        依 門市、人員 (門市總表在前)、日 的順序逐列產生 (門市, 人員, 日, 數值清單)，直接由資料庫游標串流讀取。
+        只會產生有數值的日期；數值順序同 kpis，未存的 KPI 為 0。
+        """
+        index = {k: i for i, k in enumerate(kpis)}
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "SELECT store, staff, day, kpi, value FROM kpi_daily WHERE month = ? ORDER BY store, staff, day",
+                (month_key,),
+            )
+            for (store, staff, day), group in itertools.groupby(cursor, key=lambda r: r[:3]):
+                values = [0.0] * len(kpis)
+                for *_, kpi, value in group:
+                    if kpi in index: values[index[kpi]] = value
+                yield store, staff, day, values
+
+    def daily(self, kpi, first_month, last_month, staff_level=False):
+        """指定 KPI 在月份區間內的每日數值 (長格式：month, store, staff, day, value)。"""
+        level = "staff <> ?" if staff_level else "staff = ?"
+        with self._connect() as conn:
+            return pd.read_sql_query(
+                f"SELECT month, store, staff, day, value FROM kpi_daily "
+                f"WHERE kpi = ? AND month BETWEEN ? AND ? AND {level} ORDER BY month, store, staff, day",
+                conn, params=(kpi, first_month, last_month, STORE_LEVEL),
+            )
+
+    def monthly_totals(self, kpi, first_month, last_month, staff_level=False):
+        """
+        各月總計 (月份 × 門市，人員層級時欄位為 (門市, 人員))。
+        累加欄位逐日加總；overwrite 欄位取當月最後一個非 0 值 (SQLite 的 MAX() 會帶出同列的 value)。
+        """
+        level = "staff <> ?" if staff_level else "staff = ?"
+        agg = "value, MAX(day)" if kpi in self.overwrite_kpis() else "SUM(value) AS value"
+        with self._connect() as conn:
+            totals = pd.read_sql_query(
+                f"SELECT month, store, staff, {agg} FROM kpi_daily "
+                f"WHERE kpi = ? AND month BETWEEN ? AND ? AND {level} GROUP BY month, store, staff",
+                conn, params=(kpi, first_month, last_month, STORE_LEVEL),
+            )
+        totals = totals.rename(columns={"month": "月份", "store": "門市", "staff": "人員"})
+        columns = ["門市", "人員"] if staff_level else "門市"
+        return totals.pivot_table(index="月份", columns=columns, values="value", aggfunc="sum").fillna(0.0)
+
+    def month_over_month(self, kpi, first_month, last_month, staff_level=False):
+        """月增減：回傳 (當月總計, 與上月差額, 成長率) 三個 月份 × 門市 表；上月無資料者成長率為 NaN。"""
+        totals = self.monthly_totals(kpi, first_month, last_month, staff_level)
+        delta = totals.diff()
+        pct = delta / totals.shift(1).where(lambda t: t != 0)
+        return totals, delta, pct
+
+    def rolling(self, kpi, first_month, last_month, window=7, store=None):
+        """
+        全店 (或單一門市) 的每日序列與 window 日滾動值，索引為日期。
+        累加欄位為滾動加總；overwrite 欄位 (比率) 為當日有數值門市的平均再取滾動平均。
+        """
+        daily = self.daily(kpi, first_month, last_month)
+        if store is not None: daily = daily[daily["store"] == store]
+        if daily.empty: return pd.DataFrame(columns=["每日", f"{window} 日滾動"])
+        daily["date"] = pd.to_datetime(daily["month"] + daily["day"].astype(str).str.zfill(2), format="%Y%m%d")
+        overwrite = kpi in self.overwrite_kpis()
+        per_day = daily.groupby("date")["value"].mean() if overwrite else daily.groupby("date")["value"].sum()
+        full = pd.date_range(f"{first_month}01", pd.Timestamp(f"{last_month}01") + pd.offsets.MonthEnd(0))
+        per_day = per_day.reindex(full, fill_value=np.nan if overwrite else 0.0)
+        rolled = per_day.rolling(window, min_periods=1)
+        return pd.DataFrame({"每日": per_day, f"{window} 日滾動": rolled.mean() if overwrite else rolled.sum()})
+
+def ingest_month(history, date_obj, max_workers=8, column_projection=True, force=False, grace_days=5):
+    """
+    將一個月份匯入歷史資料庫，回傳 (是否寫入, 訊息)。
+    已結帳且已匯入的月份直接略過，不呼叫任何 API；門市總表與人員分頁各掃描一次 (沿用 ScanCache)。
+    有門市讀取失敗時不寫入，避免把缺資料的月份標成已結帳。
+    """
+    month_key = date_obj.strftime('%Y%m')
+    if not force and history.is_closed(month_key): return False, f"⏭️ {month_key} 已結帳並匯入，不再讀取"
+    closed = month_is_closed(month_key, grace_days=grace_days)
+
+    df, msg, cube = scan_month_stores(date_obj, max_workers, True, column_projection)
+    if cube is None: return False, f"{month_key}：{msg}"
+    staff_df, staff_msg, staff_daily = scan_month_staff(date_obj, max_workers, True, column_projection)
+    if staff_df is None: return False, f"{month_key}：{staff_msg}"
+    failed = set(df.attrs['scan_stats']['errors']) | set(staff_df.attrs['scan_stats']['errors'])
+    if failed: return False, f"⚠️ {month_key} 有 {len(failed)} 間門市讀取失敗 ({'、'.join(sorted(failed))})，未寫入"
+
+    n = history.ingest(cube, staff_daily, closed)
+    return True, f"✅ {month_key} 已匯入 {n} 筆{'（已結帳）' if closed else '（進行中，之後可再更新）'}"
+
+# --- 整月明細匯出 (串流寫出) ---
+
+def iter_cached_month_rows(cube, staff_daily):
+    """
+    由掃描結果 (KpiCube 與 scan_month_staff 的每日矩陣) 依 門市、人員 (門市總表在前)、日 的順序
+    產生 (門市, 人員, 日, 數值清單)；數值順序同 cube.kpis，讀取失敗的門市為 NaN。
+    """
+    by_store = {}
+    for (store, staff), matrix in (staff_daily or {}).items():
+        by_store.setdefault(store, []).append((staff, matrix))
+    stores = list(cube.stores) if cube is not None else []
+    stores += sorted(s for s in by_store if s not in stores)
+    for store in stores:
+        sheets = []
+        if cube is not None and store in cube.stores: sheets.append((STORE_LEVEL, cube.values[cube.stores.index(store)]))
+        sheets += sorted(by_store.get(store, []), key=lambda item: item[0])
+        for staff, matrix in sheets:
+            for day, values in enumerate(float32_to_decimal(matrix).tolist(), start=1):
+                yield store, staff, day, values
+
+def _excel_sheet_title(name, used):
+    """Excel 工作表名稱最多 31 字且不可含 []:*?/\\ 等字元，重複時加序號。"""
+    title = "".join("_" if c in '[]:*?/\\' else c for c in str(name))[:31] or "Sheet"
+    base, n = title, 1
+    while title in used:
+        n += 1
+        title = f"{base[:31 - len(str(n)) - 1]}_{n}"
+    used.add(title)
+    return title
+
+def _export_cell(value):
+    return None if value is None or value != value else value  # NaN (讀取失敗) 輸出為空白
+
+def export_month_xlsx(fileobj, month_key, kpis, labels, rows):
+    """
+    以 openpyxl write-only 模式串流寫出整月明細，每間門市一個工作表 (人員、日期、各 KPI)。
+    rows 須依門市排序 (iter_cached_month_rows / KpiHistory.iter_month_rows)；
+    寫出時每列直接落地，記憶體用量不隨門市數與人數增加。
+    """
+    from openpyxl import Workbook
+
+    year, month = int(month_key[:4]), int(month_key[4:])
+    wb = Workbook(write_only=True)
+    used, current, ws = set(), None, None
+    for store, staff, day, values in rows:
+        if store != current:
+            ws = wb.create_sheet(title=_excel_sheet_title(store, used))
+            ws.append(["人員", "日期", *labels])
+            current = store
+        ws.append([staff or "門市總表", date(year, month, day), *(_export_cell(v) for v in values)])
+    if current is None: wb.create_sheet(title="無資料")
+    wb.save(fileobj)
+
+def export_month_csv(fileobj, month_key, kpis, labels, rows, chunk_rows=5000):
+    """同 export_month_xlsx 的資料以 CSV (UTF-8 BOM，Excel 可直接開啟) 每 chunk_rows 列寫出一次。"""
+    year, month = int(month_key[:4]), int(month_key[4:])
+    fileobj.write("\ufeff")
+    writer = csv.writer(fileobj)
+    writer.writerow(["門市", "人員", "日期", *labels])
+    for chunk in iter(lambda: list(itertools.islice(rows, chunk_rows)), []):
+        writer.writerows(
+            [store, staff or "門市總表", date(year, month, day).isoformat(), *(_export_cell(v) for v in values)]
+            for store, staff, day, values in chunk
+        )
@@ -0,0 +1,301 @@
+"""
+收班尖峰壓力測試：以 Streamlit AppTest 同時開多個 session 操作 app.py，後端為假後端 (fake_backend)，
+不需要 Google 帳號也不會呼叫真實 API。
+
+    python loadtest.py                                  # 9 間門市 × 每店 3 人，每人送出 2 次，1 個管理員持續掃描
+    python loadtest.py --staff 5 --rounds 3 --admins 2 --latency-ms 80
+    python loadtest.py --quota 60 --json load.json      # 以 Sheets 預設每分鐘配額觀察寫入吞吐上限
+
+每位人員一個 session：選門市 → 輸入門市密碼登入 → 選人員 → 填表 →「🔍 預覽」→「✅ 確認上傳」，
+重複 --rounds 次 (都寫到今天同一列，刻意製造同列競爭)。管理員 session 登入後反覆按
+「🔄 掃描並彙整全店數據」，直到所有人員送出完畢。
+
+報表：
+    送出回應   按下「✅ 確認上傳」到畫面重新繪製完成 (含介面成功後停留的 2 秒)；所有 session 與正式環境
+               一樣在同一個程序內執行，數值也反映同時執行的 session 彼此搶 CPU 的情形
+    寫入延遲   進入上傳佇列到背景寫入試算表完成
+    吞吐量     每秒送出數 / 每秒寫完數
+    總和驗證   佇列清空後逐列比對：寫入後 − 寫入前 應等於該列所有送出的合計，不符即為遺失或重複寫入
+
+AppTest 原本只支援單一 session：每次執行開始時把全域 Runtime 換成替身、結束時清掉，並會暫時替換 st.secrets。
+這裡預先設定好 st.secrets 與 global.appTest、讓 Runtime.instance() 在被其他 session 清掉後沿用最近一個替身，
+並將腳本編譯改為一次一個，多個 session 才能在各自的執行緒中同時執行。
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import numpy as np
+
+import kpi_core
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+ADMIN_PASSWORD = "loadtest-admin"
+# 只填累加欄位才能以總和驗證；其餘欄位維持 0 (overwrite 欄位會被覆寫成 0，不列入驗證)
+SUBMIT_FIELDS = ["毛利", "門號"]
+
+def prepare_concurrent_apptest():
+    """讓多個 AppTest 能在不同執行緒同時執行 (見模組說明)。"""
+    from streamlit import config, logger
+    from streamlit.runtime.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    last = []
+
+    def instance(cls):
+        if cls._instance is not None:
+            last[:] = [cls._instance]
+            return cls._instance
+        if last: return last[0]
+        raise RuntimeError("Runtime hasn't been created!")
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: cls._instance is not None or bool(last))
+    config.set_option("global.appTest", True)
+
+    # 每次執行都會重新編譯腳本；部分 Python 版本在多執行緒同時 ast.parse 會出錯，改為一次編譯一個
+    compile_lock = threading.Lock()
+    get_bytecode = ScriptCache.get_bytecode
+    def locked_get_bytecode(self, script_path):
+        with compile_lock: return get_bytecode(self, script_path)
+    ScriptCache.get_bytecode = locked_get_bytecode
+    # 在工作執行緒建立 AppTest 時的 ScriptRunContext 警告與 use_container_width 即將淘汰的警告每次執行都會出現，只保留錯誤
+    logger.set_log_level("error")
+
+def install_secrets(settings):
+    """所有 session 共用的 st.secrets (AppTest 未指定 secrets 時不會替換)。"""
+    import streamlit as st
+    from streamlit.runtime.secrets import Secrets
+    secrets = Secrets()
+    secrets._secrets = settings
+    st.secrets = secrets
+
+def percentiles(values, qs=(50, 95, 99)):
+    if not len(values): return {f"p{q}": None for q in qs}
+    return {f"p{q}": round(float(np.percentile(values, q)), 3) for q in qs}
+
+# --- 單一 session 的操作 ---
+
+def _button(at, label):
+    return next(b for b in at.button if b.label == label)
+
+def _check(at):
+    """腳本拋出例外或顯示錯誤訊息時中止這個 session。"""
+    if at.exception: raise RuntimeError(at.exception[0].message)
+    if at.error: raise RuntimeError(at.error[0].value)
+
+def open_session(store, password, timeout):
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    at.run()
+    at.sidebar.selectbox(key="sidebar_store_select").select(store).run()
+    if store == kpi_core.STORE_NAMES[0]:
+        next(t for t in at.text_input if t.label == "🔑 請輸入管理員密碼").input(password).run()
+    else:
+        next(t for t in at.text_input if t.label == "密碼").input(password)
+        _button(at, "登入").click().run()
+    _check(at)
+    return at
+
+def staff_session(store, password, staff, rounds, rng, timeout, ramp, record):
+    """一位人員：登入後送出 rounds 次日報，每次送出記錄 (門市, 人員, 數值, 回應秒數, 錯誤)。"""
+    config = kpi_core.kpi_layout().config
+    time.sleep(rng.uniform(0, ramp))
+    at = open_session(store, password, timeout)
+    at.sidebar.selectbox(key="sidebar_user_select").select(staff).run()
+    _check(at)
+    for _ in range(rounds):
+        values = {f: rng.randint(1, 50) * (100 if config[f]['type'] == 'money' else 1) for f in SUBMIT_FIELDS}
+        for field, val in values.items():
+            next(n for n in at.number_input if n.label == config[field]['label']).set_value(val)
+        _button(at, "🔍 預覽").click().run()
+        _check(at)
+        t0 = time.perf_counter()
+        _button(at, "✅ 確認上傳").click().run()
+        latency = time.perf_counter() - t0
+        # 成功時介面清掉預覽並重新繪製；失敗時留下錯誤訊息與預覽
+        error = at.error[0].value if at.error else (None if at.session_state["preview_data"] is None else "預覽未清除")
+        if at.exception: error = at.exception[0].message
+        record(store, staff, values, latency, error)
+        if error: break
+
+def admin_session(timeout, stop, record):
+    """管理員：登入全店總表後反覆掃描，直到 stop 被設定。"""
+    at = open_session(kpi_core.STORE_NAMES[0], ADMIN_PASSWORD, timeout)
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        _button(at, "🔄 掃描並彙整全店數據").click().run()
+        _check(at)
+        record(time.perf_counter() - t0)
+
+# --- 驗證 ---
+
+def row_values(world, store, staff, day, fields):
+    """從假後端直接讀出某人某日的欄位值 (空白視為 0)。"""
+    config = kpi_core.kpi_layout().config
+    tab = world.tab(f"{day:%Y_%m}_{store}業績日報表", staff)
+    row = kpi_core.DAY_FIRST_ROW - 1 + day.day - 1
+    with world.lock:
+        cells = {f: tab.values[row, kpi_core.KPI_FIRST_COL - 1 + config[f]['col']] for f in fields}
+    return {f: 0.0 if np.isnan(v) else float(v) for f, v in cells.items()}
+
+def verify_totals(world, before, submissions, day):
+    """逐列比對寫入前後的差額與送出合計，回傳不符的列。"""
+    expected = {key: dict.fromkeys(SUBMIT_FIELDS, 0.0) for key in before}
+    for s in submissions:
+        if s['error']: continue
+        for f, v in s['values'].items(): expected[(s['store'], s['staff'])][f] += v
+    mismatches = []
+    for (store, staff), base in before.items():
+        after = row_values(world, store, staff, day, SUBMIT_FIELDS)
+        for f in SUBMIT_FIELDS:
+            written = round(after[f] - base[f], 6)
+            if written != expected[(store, staff)][f]:
+                mismatches.append({"store": store, "staff": staff, "field": f,
+                                   "expected": expected[(store, staff)][f], "written": written})
+    return mismatches
+
+# --- 主流程 ---
+
+def run(args):
+    stores = kpi_core.STORE_NAMES[1:1 + args.stores]
+    staff_names = [f"人員{j + 1:02d}" for j in range(args.staff)]
+    workdir = tempfile.mkdtemp(prefix="kpi-load-")
+    settings = {
+        "KPI_BACKEND": "fake", "TARGET_FOLDER_ID": "fake-root", "admin_password": ADMIN_PASSWORD,
+        "store_passwords": {s: f"pw-{i}" for i, s in enumerate(stores)},
+        "FAKE_STAFF": args.staff, "FAKE_MONTHS": 1, "FAKE_LATENCY_MS": args.latency_ms,
+        "FAKE_QUOTA_ERROR_RATE": args.error_rate, "FAKE_SEED": args.seed,
+        "SHEETS_QUOTA_PER_MINUTE": args.quota, "DRIVE_QUOTA_PER_MINUTE": max(args.quota, 600),
+        "API_TRACE_MAX_EVENTS": 10 ** 6, "WRITE_QUEUE_PATH": os.path.join(workdir, "write_queue.sqlite3"),
+        "HISTORY_PATH": os.path.join(workdir, "kpi_history.sqlite3"), "SNAPSHOT_DIR": os.path.join(workdir, "snapshots"),
+    }
+    kpi_core.configure(settings)
+    install_secrets(settings)
+    prepare_concurrent_apptest()
+    import fake_backend
+    world = fake_backend.get_fake_backend().world
+
+    # 暖機：先跑一個 session，建立共用資源 (設定、上傳佇列、背景預載) 並讓 Runtime 替身就位
+    t0 = time.perf_counter()
+    from streamlit.testing.v1 import AppTest
+    AppTest.from_file(APP_PATH, default_timeout=args.timeout).run()
+    warmup = time.perf_counter() - t0
+    print(f"🔥 暖機 {warmup:.2f}s・{len(stores)} 間門市 × {len(staff_names)} 人 × {args.rounds} 次送出・管理員 {args.admins} 人", flush=True)
+
+    today = date.today()
+    before = {(s, p): row_values(world, s, p, today, SUBMIT_FIELDS) for s in stores for p in staff_names}
+    tracer = kpi_core.get_api_tracer()
+    tracer.clear()
+    queue, _ = kpi_core.get_write_queue()
+
+    lock = threading.Lock()
+    submissions, scans, session_errors = [], [], []
+
+    def record_submit(store, staff, values, latency, error):
+        with lock: submissions.append({"store": store, "staff": staff, "values": values, "latency": latency, "error": error})
+
+    def record_scan(latency):
+        with lock: scans.append(latency)
+
+    def guarded(fn, *a):
+        try: fn(*a)
+        except Exception as e:
+            with lock: session_errors.append(f"{type(e).__name__}: {e}")
+            if args.verbose: traceback.print_exc()
+
+    stop = threading.Event()
+    admins = [threading.Thread(target=guarded, args=(admin_session, args.timeout, stop, record_scan), daemon=True)
+              for _ in range(args.admins)]
+    rng = random.Random(args.seed)
+    t_start = time.perf_counter()
+    for t in admins: t.start()
+    with ThreadPoolExecutor(max_workers=args.concurrency or len(before)) as pool:
+        for store, staff in before:
+            pool.submit(guarded, staff_session, store, settings["store_passwords"][store], staff, args.rounds,
+                        random.Random(rng.random()), args.timeout, args.ramp, record_submit)
+    submit_seconds = time.perf_counter() - t_start
+    stop.set()
+    for t in admins: t.join()
+
+    # 等背景寫入清空佇列後再驗證
+    t0 = time.perf_counter()
+    while queue.counts().get('pending') and time.perf_counter() - t0 < args.drain_timeout: time.sleep(0.1)
+    drain_seconds = time.perf_counter() - t0
+    counts = queue.counts()
+    mismatches = verify_totals(world, before, submissions, today)
+
+    ok = [s for s in submissions if not s['error']]
+    timings = queue.timings()
+    write_latency = (timings['done_at'] - timings['created_at']).to_numpy()
+    write_span = timings['done_at'].max() - timings['created_at'].min() if len(timings) else 0
+    trace = tracer.frame()
+    return {
+        "stores": len(stores), "staff": len(staff_names), "rounds": args.rounds, "admins": args.admins,
+        "latency_ms": args.latency_ms, "error_rate": args.error_rate, "quota": args.quota,
+        "warmup_s": round(warmup, 3), "submit_phase_s": round(submit_seconds, 3), "drain_s": round(drain_seconds, 3),
+        "submits_ok": len(ok), "submits_failed": len(submissions) - len(ok), "session_errors": session_errors,
+        "submit_latency_s": percentiles([s['latency'] for s in ok]),
+        "submit_per_s": round(len(ok) / submit_seconds, 2) if submit_seconds else None,
+        "write_latency_s": percentiles(write_latency),
+        "writes_per_s": round(len(timings) / write_span, 2) if write_span else None,
+        "queue": {k: int(v) for k, v in counts.items()},
+        "scans": len(scans), "scan_latency_s": percentiles(scans),
+        "api_calls": int(len(trace)), "retries": int((trace["attempts"] - 1).sum()) if len(trace) else 0,
+        "rows_checked": len(before), "mismatches": mismatches,
+        "trace": trace,
+    }
+
+def report(result):
+    def pct(d): return "・".join(f"{k} {v:.2f}s" for k, v in d.items() if v is not None) or "—"
+    print(f"📤 送出：成功 {result['submits_ok']}・失敗 {result['submits_failed']}・"
+          f"{result['submit_phase_s']:.1f}s 內完成 ({result['submit_per_s']} 筆/秒)")
+    print(f"   送出回應：{pct(result['submit_latency_s'])}")
+    print(f"✍️ 寫入：佇列 {result['queue']}・清空等待 {result['drain_s']:.1f}s・{result['writes_per_s']} 筆/秒")
+    print(f"   寫入延遲：{pct(result['write_latency_s'])}")
+    print(f"🔄 全店掃描 {result['scans']} 次：{pct(result['scan_latency_s'])}")
+    print(f"🔬 API 呼叫 {result['api_calls']} 次・重試 {result['retries']} 次")
+    if len(result['trace']): print(kpi_core.summarize_trace(result['trace']).to_string())
+    for e in result['session_errors'][:10]: print(f"❌ session 錯誤：{e}")
+    if result['mismatches']:
+        print(f"❌ 總和不符 {len(result['mismatches'])} 處 (共檢查 {result['rows_checked']} 列)：")
+        for m in result['mismatches'][:20]:
+            print(f"   {m['store']} {m['staff']} {m['field']}：應寫入 {m['expected']:g}，實際 {m['written']:g}")
+    else: print(f"✅ 總和驗證：{result['rows_checked']} 列的寫入差額皆等於送出合計")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="以 AppTest 模擬多個 session 同時送出日報與全店掃描")
+    parser.add_argument("--stores", type=int, default=len(kpi_core.STORE_NAMES) - 1,
+                        choices=range(1, len(kpi_core.STORE_NAMES)), metavar="N", help="參與的門市數")
+    parser.add_argument("--staff", type=int, default=3, help="每間門市的人員數 (每人一個 session)")
+    parser.add_argument("--rounds", type=int, default=2, help="每人送出次數")
+    parser.add_argument("--admins", type=int, default=1, help="同時反覆全店掃描的管理員 session 數")
+    parser.add_argument("--concurrency", type=int, help="同時執行的人員 session 上限，預設全部同時")
+    parser.add_argument("--ramp", type=float, default=5.0, help="人員 session 在幾秒內陸續開始")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="每次 API 請求的模擬延遲")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="每次 API 請求回傳 429 的機率")
+    parser.add_argument("--quota", type=int, default=300, help="ApiGuard 的 Sheets 每分鐘配額")
+    parser.add_argument("--timeout", type=float, default=300, help="單次腳本執行的逾時秒數")
+    parser.add_argument("--drain-timeout", type=float, default=600, help="等待上傳佇列清空的秒數上限")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="結果輸出路徑")
+    parser.add_argument("--verbose", action="store_true", help="印出 session 錯誤的完整堆疊")
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({k: v for k, v in result.items() if k != "trace"}, f, ensure_ascii=False, indent=1)
+    failed = result['mismatches'] or result['session_errors'] or result['submits_failed'] or result['queue'].get('pending')
+    return 1 if failed or result['queue'].get('failed') else 0
+
+if __name__ == "__main__":
+    sys.exit(main())